@@ -48,6 +48,12 @@ def main():
         default=False,
         help='Verify dictionary files specified'
         )
+    parser.add_option(
+        '--force',
+        action='store_true',
+        default=False,
+        help='Verify even if files have not changed since last verified'
+        )
     parser.add_option(
         '-d', '--debug',
         action='store_true',
@@ -60,6 +66,75 @@ def main():
         default=False,
         help='Print metadata for dictionary files specified'
         )
+    parser.add_option(
+        '-k', '--sort-keys',
+        action='store_true',
+        default=False,
+        help='Build collation sort key index for dictionary files specified'
+        )
+    parser.add_option(
+        '-f', '--fuzzy-index',
+        action='store_true',
+        default=False,
+        help='Build typo tolerant title index for dictionary files specified'
+        )
+    parser.add_option(
+        '-t', '--fulltext-index',
+        action='store_true',
+        default=False,
+        help='Build full-text index of articles for dictionary files specified'
+        )
+    parser.add_option(
+        '-s', '--substring-index',
+        action='store_true',
+        default=False,
+        help='Build infix title search index for dictionary files specified'
+        )
+    parser.add_option(
+        '-b', '--block-manifest',
+        action='store_true',
+        default=False,
+        help='Verify dictionary files specified and write block checksums '
+        'for faster parallel verification'
+        )
+    parser.add_option(
+        '--build',
+        metavar='FILE',
+        help='Build dictionary FILE from JSON lines files specified, '
+        'each line an object with title, text and optional meta'
+        )
+    parser.add_option(
+        '--build-metadata',
+        metavar='FILE',
+        help='JSON file with metadata (title, lang etc.) '
+        'for dictionary being built'
+        )
+    parser.add_option(
+        '--compression',
+        default='zlib',
+        help='Article compression for dictionary being built: '
+        'zlib (default), bz2 or xz'
+        )
+    parser.add_option(
+        '--max-volume-size',
+        type='int',
+        metavar='MB',
+        help='Split dictionary being built into volumes of at most MB '
+        'megabytes'
+        )
+    parser.add_option(
+        '--block-size',
+        type='int',
+        metavar='KB',
+        help='Store articles of dictionary being built or converted '
+        'in compressed blocks of about KB kilobytes (format version 2)'
+        )
+    parser.add_option(
+        '--convert',
+        metavar='DIR',
+        help='Convert dictionary files specified to format version 2 '
+        'with block compressed articles, writing them to DIR'
+        )
     parser.add_option(
         '-e', '--dev-extras',
         action='store_true',
@@ -82,12 +157,42 @@ def main():
 
 
     if options.verify:
-        verify(args)
+        verify(args, options.force)
 
     if options.metadata:
         metadata(args)
 
-    if options.identify or options.verify or options.metadata:
+    if options.sort_keys:
+        build_indexes(args, lambda v: v.build_sort_key_index(), 'sort keys')
+
+    if options.fuzzy_index:
+        build_indexes(args, lambda v: v.build_fuzzy_index(), 'fuzzy index')
+
+    if options.fulltext_index:
+        build_indexes(args, lambda v: v.build_fulltext_index(),
+                      'full-text index')
+
+    if options.substring_index:
+        build_indexes(args, lambda v: v.build_substring_index(),
+                      'substring index')
+
+    if options.block_manifest:
+        build_indexes(args, lambda v: v.build_block_manifest(),
+                      'block manifest')
+
+    if options.build:
+        build(options.build, args, options.build_metadata,
+              options.compression, options.max_volume_size,
+              options.block_size)
+
+    if options.convert:
+        convert(args, options.convert, options.compression,
+                options.block_size)
+
+    if (options.identify or options.verify or options.metadata or
+        options.sort_keys or options.fuzzy_index or options.fulltext_index or
+        options.substring_index or options.block_manifest or options.build or
+        options.convert):
         raise SystemExit
 
     import aarddict.qtui
@@ -110,9 +215,10 @@ def identify(file_names):
                                               volume.total_volumes))
         print tmpl % ('Version', volume.version)
         print tmpl % ('Articles', volume.article_count)
+        print tmpl % ('File format', volume.format_version)
 
 
-def verify(file_names):
+def verify(file_names, force=False):
     from .dictionary import Volume, VerifyError
 
     ERASE_LINE = '\033[2K'
@@ -124,14 +230,16 @@ def verify(file_names):
     for file_name in file_names:
         volume = Volume(file_name)
         try:
-            for progress in volume.verify():
+            for progress in volume.verify(force=force):
                 sys.stdout.write(ERASE_LINE+'\r')
                 sys.stdout.write('Verifying %s: %.1f%%' % (file_name, 100*progress))
                 sys.stdout.flush()
-        except VerifyError:
+        except VerifyError, e:
             sys.stdout.write(ERASE_LINE+'\r')
             sys.stdout.write(file_name+' ')
             sys.stdout.write(BOLD+RED+'[CORRUPTED]'+ENDC)
+            if e.corrupt_ranges:
+                sys.stdout.write(' bytes %s' % e)
             sys.stdout.write('\n')
             sys.stdout.flush()
         else:
@@ -142,6 +250,78 @@ def verify(file_names):
             sys.stdout.flush()
 
 
+def build_indexes(file_names, build, title):
+
+    from .dictionary import Volume
+
+    ERASE_LINE = '\033[2K'
+
+    for file_name in file_names:
+        volume = Volume(file_name)
+        for progress in build(volume):
+            sys.stdout.write(ERASE_LINE+'\r')
+            sys.stdout.write('Building %s for %s: %.1f%%' %
+                             (title, file_name, 100*progress))
+            sys.stdout.flush()
+        sys.stdout.write(ERASE_LINE+'\r')
+        sys.stdout.write('%s %s written\n' % (file_name, title))
+        sys.stdout.flush()
+        volume.close()
+
+
+def build(file_name, input_file_names, metadata_file_name=None,
+          compression='zlib', max_volume_size=None, block_size=None):
+
+    import simplejson
+    from .writer import Writer, read_jsonl, default_max_volume_size
+
+    ERASE_LINE = '\033[2K'
+
+    metadata = {}
+    if metadata_file_name:
+        with open(metadata_file_name, 'rb') as f:
+            metadata = simplejson.load(f)
+    if max_volume_size:
+        max_volume_size = max_volume_size << 20
+    else:
+        max_volume_size = default_max_volume_size
+    if block_size:
+        block_size = block_size << 10
+    writer = Writer(file_name, metadata, compression, max_volume_size,
+                    block_size=block_size)
+    for stage, count in writer.write(read_jsonl(input_file_names)):
+        sys.stdout.write(ERASE_LINE+'\r')
+        sys.stdout.write('Building %s: %s %d' % (file_name, stage, count))
+        sys.stdout.flush()
+    sys.stdout.write(ERASE_LINE+'\r')
+    for name in writer.file_names:
+        sys.stdout.write('%s written\n' % name)
+    sys.stdout.flush()
+
+
+def convert(file_names, output_dir, compression='zlib', block_size=None):
+
+    from .writer import convert, default_block_size
+
+    ERASE_LINE = '\033[2K'
+
+    block_size = block_size << 10 if block_size else default_block_size
+    for file_name in file_names:
+        output_file_name = path.join(output_dir,
+                                     path.basename(file_name))
+        if path.abspath(output_file_name) == path.abspath(file_name):
+            sys.stderr.write('%s: output would overwrite input\n' % file_name)
+            continue
+        for stage, count in convert(file_name, output_file_name,
+                                    compression, block_size):
+            sys.stdout.write(ERASE_LINE+'\r')
+            sys.stdout.write('Converting %s: %s %d' % (file_name, stage, count))
+            sys.stdout.flush()
+        sys.stdout.write(ERASE_LINE+'\r')
+        sys.stdout.write('%s written\n' % output_file_name)
+    sys.stdout.flush()
+
+
 def metadata(file_names):
     from .dictionary import Volume
     for file_name in file_names:
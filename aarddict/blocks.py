@@ -0,0 +1,212 @@
+# This file is part of Aard Dictionary <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2010 Igor Tkach
+
+"""
+Block checksum manifest for parallel and incremental verification.
+
+Volume content covered by sha1sum is split into fixed size blocks and
+SHA-1 of each block is stored in a manifest file, written only after
+whole content is found to match volume's sha1sum. Blocks can then be
+checked in any order, by several threads at once (hashlib releases the
+interpreter lock while hashing), and verification interrupted midway
+picks up from blocks already checked.
+
+"""
+
+from __future__ import with_statement
+
+import os
+
+from hashlib import sha1
+from struct import pack
+from threading import Lock
+
+import simplejson
+
+from aarddict.dictionary import (DictFormatError, VerifyError, WorkerPool,
+                                 atomic_write, read_index_header)
+
+default_block_size = 4 << 20
+
+digest_len = 20
+
+BLOCK_MANIFEST_SPEC = (('signature',     '>4s'), # string 'aarb'
+                       ('version',       '>H'), # format version, current value 1
+                       ('index_count',   '>L'), # must match volume's index count
+                       ('sha1sum',       '>40s'), # volume's sha1sum
+                       ('offset',        '>L'), # offset of first block in volume
+                       ('file_size',     '>Q'), # volume file size
+                       ('block_size',    '>L'), # size of each block but last
+                       ('block_count',   '>L'), # number of block digests
+                       )
+
+_pool = None
+
+_pool_lock = Lock()
+
+def pool():
+    """
+    Worker pool for checking blocks, separate from lookup pools so
+    that verification does not hold up lookups.
+
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+        return _pool
+
+
+def merge_ranges(ranges):
+    """
+    Merge sorted (start, end) ranges that touch or overlap.
+
+    >>> merge_ranges([(0, 4), (4, 8), (12, 16)])
+    [(0, 8), (12, 16)]
+    >>> merge_ranges([])
+    []
+
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class BlockManifest(object):
+    """
+    SHA-1 digests of consecutive blocks of volume content, stored as
+    index file keyed by volume's sha1sum. File consists of header
+    followed by block_count 20 byte digests.
+
+    """
+
+    ext = '.blocks'
+    signature = 'aarb'
+    version = 1
+    description = 'block manifest'
+
+    def __init__(self, file_name, index_count):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            header = read_index_header(f, BLOCK_MANIFEST_SPEC, self,
+                                       index_count)
+            self.sha1sum = header['sha1sum']
+            self.offset = header['offset']
+            self.file_size = header['file_size']
+            self.block_size = header['block_size']
+            self.block_count = header['block_count']
+            self.digests = f.read(digest_len*self.block_count)
+        if len(self.digests) != digest_len*self.block_count:
+            raise DictFormatError(file_name, 'Block manifest is truncated')
+
+    @classmethod
+    def build(cls, file_name, words, volume_file_name, sha1sum, offset,
+              block_size=None):
+        """
+        Compute block digests of volume and write them to file_name,
+        yielding progress. Raise VerifyError and write nothing if
+        volume content does not match sha1sum.
+
+        """
+        block_size = block_size or default_block_size
+        file_size = os.stat(volume_file_name).st_size
+        size = float(max(1, file_size - offset))
+        result = sha1()
+        digests = []
+        with open(volume_file_name, 'rb') as f:
+            f.seek(offset)
+            while True:
+                s = f.read(block_size)
+                if not s:
+                    break
+                result.update(s)
+                digests.append(sha1(s).digest())
+                yield (f.tell() - offset)/size
+        if result.hexdigest() != sha1sum:
+            raise VerifyError()
+        with atomic_write(file_name) as out:
+            out.write(pack('>4sHL40sLQLL', cls.signature, cls.version,
+                           len(words), sha1sum, offset, file_size,
+                           block_size, len(digests)))
+            out.write(''.join(digests))
+        yield 1.0
+
+    def block_range(self, i):
+        start = self.offset + i*self.block_size
+        return start, min(start + self.block_size, self.file_size)
+
+    def check_block(self, volume_file_name, i):
+        start, end = self.block_range(i)
+        with open(volume_file_name, 'rb') as f:
+            f.seek(start)
+            s = f.read(end - start)
+        return sha1(s).digest() == self.digests[digest_len*i:digest_len*(i+1)]
+
+    def verify(self, volume_file_name, executor, state_file_name):
+        """
+        Check blocks not yet verified according to state file,
+        yielding progress. If interrupted, blocks checked so far are
+        saved to state file so that next run skips them. Raise
+        VerifyError with corrupt byte ranges if any block does not
+        match its digest.
+
+        """
+        stat = os.stat(volume_file_name)
+        stamp = [stat.st_size, int(stat.st_mtime), self.block_size]
+        done = self._load_state(state_file_name, stamp)
+        corrupt = []
+        tasks = [(i, executor.submit(self.check_block, volume_file_name, i))
+                 for i in xrange(self.block_count) if i not in done]
+        count = float(max(1, self.block_count))
+        complete = False
+        try:
+            for i, task in tasks:
+                if task.wait():
+                    done.add(i)
+                else:
+                    corrupt.append(self.block_range(i))
+                yield (len(done) + len(corrupt))/count
+            complete = True
+        finally:
+            for _, task in tasks:
+                task.cancel()
+            if complete:
+                if os.path.exists(state_file_name):
+                    os.remove(state_file_name)
+            else:
+                self._save_state(state_file_name, stamp, done)
+        if stat.st_size != self.file_size:
+            corrupt.append((min(stat.st_size, self.file_size),
+                            max(stat.st_size, self.file_size)))
+        if corrupt:
+            raise VerifyError(merge_ranges(sorted(corrupt)))
+
+    def _load_state(self, state_file_name, stamp):
+        if os.path.exists(state_file_name):
+            try:
+                with open(state_file_name, 'rb') as f:
+                    state = simplejson.load(f)
+                if state['stamp'] == stamp:
+                    return set(state['done'])
+            except Exception:
+                pass
+        return set()
+
+    def _save_state(self, state_file_name, stamp, done):
+        with open(state_file_name, 'wb') as f:
+            simplejson.dump({'stamp': stamp, 'done': sorted(done)}, f)
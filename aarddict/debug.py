@@ -69,8 +69,19 @@ def rungc():
 def dump_cache_stats():
     print '====>\t', 'cache stats', datetime.strftime(datetime.now(), '%X')
     for obj in gc.get_objects():
-        if isinstance(obj, dictionary.CacheList):
+        if isinstance(obj, dictionary.LRUCache):
             ratio_str = '%.2f' % (float(obj.hit)/obj.miss) if obj.miss else ''
-            print '\t', obj.name, ('\thit/miss: %s\thit: %5d\tmiss: %5d\tsize: %3d' 
-                                   % (ratio_str, obj.hit, obj.miss, len(obj.cache)))
-    
+            print '\t', obj.name, ('\thit/miss: %s\thit: %5d\tmiss: %5d'
+                                   '\tevicted: %5d\tsize: %3d\tbytes: %d'
+                                   % (ratio_str, obj.hit, obj.miss,
+                                      obj.evictions, len(obj), obj.size))
+
+
+def dump_codec_stats():
+    print '====>\t', 'codec stats', datetime.strftime(datetime.now(), '%X')
+    for codec in dictionary.codecs:
+        avg_str = '%.3f' % (1000*codec.time/codec.count) if codec.count else ''
+        print '\t', codec.name, ('\tcount: %6d\tfailures: %3d\ttime: %.3fs'
+                                 '\tavg: %s ms'
+                                 % (codec.count, codec.failures,
+                                    codec.time, avg_str))
@@ -18,19 +18,29 @@ import logging
 import zlib
 import bz2
 import os
+import sys
+import atexit
+import base64
+import unicodedata
+import time
 import mmap
-
-from bisect import bisect_left
-from struct import calcsize, unpack
-from collections import defaultdict
+import tempfile
+import shutil
+import re
+
+from array import array
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from struct import calcsize, unpack, unpack_from, pack
 from uuid import UUID
-from threading import local
+from threading import Lock, Thread, Condition, Event
+from Queue import Queue
 
 import simplejson
 try:
-    from icu import Locale, Collator
+    from icu import Locale, Collator, ICU_VERSION
 except ImportError:
-    from PyICU import Locale, Collator
+    from PyICU import Locale, Collator, ICU_VERSION
 
 
 PRIMARY = Collator.PRIMARY
@@ -39,22 +49,217 @@ TERTIARY = Collator.TERTIARY
 
 from hashlib import sha1
 
-compression = (zlib.compress, bz2.compress)
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
-decompression = (zlib.decompress, bz2.decompress)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+compression = (zlib.compress, bz2.compress)
 
 max_redirect_levels = 5
 
+word_cache_size = 10000
+
+#memory taken by cached words of each volume, in bytes, 0 for no limit
+word_cache_bytes = 1 << 20
+
+article_cache_size = 1000
+
+article_cache_bytes = 16 << 20
+
+redirect_cache_size = 10000
+
+block_cache_size = 64
+
+block_cache_bytes = 16 << 20
+
+#file format versions this module can read: version 2 stores articles
+#in compressed blocks instead of compressing each one
+format_versions = (1, 2)
+
+glob_chunk_size = 1000
+
+index_dir = os.path.join(os.path.expanduser('~'), '.aarddict', 'index')
+
+
+verify_cache_file = os.path.join(os.path.expanduser('~'), '.aarddict',
+                                 'verified.json')
+
+_verify_cache_lock = Lock()
+
+volume_cache_file = os.path.join(os.path.expanduser('~'), '.aarddict',
+                                 'volumes.json')
+
+_volume_cache = None
+
+_volume_cache_lock = Lock()
+
+#metadata needed to open volume, anything else (such as siteinfo)
+#is read from volume file when first needed
+volume_summary_keys = ('article_count', 'index_language', 'article_language',
+                       'title', 'version', 'description', 'copyright',
+                       'license', 'source', 'language_links', 'lang',
+                       'sitelang')
+
+
+def sidecar_path(volume_id, ext):
+    return os.path.join(index_dir, volume_id + ext)
+
+
+def replace_file(tmp_name, file_name):
+    """
+    Move finished tmp_name over file_name. On POSIX rename replaces
+    file_name atomically, so other processes see either old or new
+    file, never a missing one. Windows can not rename over existing
+    file, so there it is removed first.
+
+    """
+    try:
+        os.rename(tmp_name, file_name)
+    except OSError:
+        if os.name != 'nt' or not os.path.exists(file_name):
+            raise
+        try:
+            os.remove(file_name)
+        except OSError:
+            #another process replaced it meanwhile
+            pass
+        os.rename(tmp_name, file_name)
+
+
+@contextmanager
+def atomic_write(file_name):
+    """
+    Open file_name.tmp for writing and move it over file_name once
+    written, so that readers never see partially written file. The
+    temporary file is removed if writing fails.
+
+    """
+    tmp_name = file_name + '.tmp'
+    f = open(tmp_name, 'wb')
+    try:
+        try:
+            yield f
+        finally:
+            f.close()
+    except:
+        os.remove(tmp_name)
+        raise
+    replace_file(tmp_name, file_name)
+
+
+def _file_identity(file_name, sha1sum):
+    st = os.stat(file_name)
+    return [st.st_size, st.st_mtime, st.st_ino, sha1sum]
+
+
+def _read_json(file_name):
+    try:
+        with open(file_name, 'rb') as f:
+            return simplejson.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_json(file_name, obj):
+    cache_dir = os.path.dirname(file_name)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        simplejson.dump(obj, f, indent=2)
+    replace_file(tmp_name, file_name)
+
+
+def _read_verify_cache():
+    return _read_json(verify_cache_file)
+
+
+def _update_verify_cache(file_name, identity, ok, corrupt_ranges=()):
+    """
+    Record verification outcome for file, keyed by its absolute path
+    and valid while its size, modification time, inode and sha1sum
+    stay the same.
+
+    """
+    with _verify_cache_lock:
+        cache = _read_verify_cache()
+        cache[os.path.abspath(file_name)] = dict(identity=identity, ok=ok,
+                                                 corrupt_ranges=corrupt_ranges)
+        try:
+            _write_json(verify_cache_file, cache)
+        except (IOError, OSError):
+            logging.warning('Failed to save %s', verify_cache_file,
+                            exc_info=1)
+
+
+def _file_stamp(file_name):
+    st = os.stat(file_name)
+    return [st.st_size, st.st_mtime]
+
+
+def _cached_volume(file_name):
+    """
+    Return (header, metadata summary, languages, article url) saved
+    when volume file was last opened, or None if it was not opened
+    before or has changed since.
+
+    """
+    global _volume_cache
+    try:
+        stamp = _file_stamp(file_name)
+    except OSError:
+        return None
+    with _volume_cache_lock:
+        if _volume_cache is None:
+            _volume_cache = _read_json(volume_cache_file)
+        cached = _volume_cache.get(os.path.abspath(file_name))
+    if (not cached or cached.get('stamp') != stamp or
+        'article_url' not in cached):
+        return None
+    header = dict(cached['header'])
+    for name, fmt in HEADER_SPEC:
+        if fmt.endswith('s'):
+            header[name] = str(header[name])
+    header['uuid'] = UUID(header['uuid']).bytes
+    return (header, cached['meta'], tuple(map(str, cached['languages'])),
+            cached['article_url'])
+
+
+def _cache_volume(file_name, header, meta, languages, article_url):
+    global _volume_cache
+    header = dict(header)
+    header['uuid'] = UUID(bytes=header['uuid']).hex
+    summary = dict((key, meta[key]) for key in volume_summary_keys
+                   if key in meta)
+    cached = dict(stamp=_file_stamp(file_name), header=header,
+                  meta=summary, languages=languages,
+                  article_url=article_url)
+    with _volume_cache_lock:
+        if _volume_cache is None:
+            _volume_cache = _read_json(volume_cache_file)
+        _volume_cache[os.path.abspath(file_name)] = cached
+        try:
+            _write_json(volume_cache_file, _volume_cache)
+        except (IOError, OSError):
+            logging.warning('Failed to save %s', volume_cache_file,
+                            exc_info=1)
+
 
 def format_title(d, with_vol_num=True):
     parts = [d.title]
-    lang = d.metadata.get('lang')
-    if lang:
-        parts.append(u' (%s)' % lang)
-    else:
-        sitelang = d.metadata.get('sitelang')
-        if sitelang:
-            parts.append(u' (%s)' % sitelang)
+    if d.lang:
+        parts.append(u' (%s)' % d.lang)
+    elif d.sitelang:
+        parts.append(u' (%s)' % d.sitelang)
     if with_vol_num and d.total_volumes > 1:
         parts.append(u' Vol. %s' % d.volume)
     return u''.join(parts)
@@ -71,16 +276,114 @@ def calcsha1(file_name, offset, chunksize=100000):
             yield (f.tell(), result)
 
 
-def decompress(s):
-    decompressed = s
-    for decomp in decompression:
+class Codec(object):
+    """
+    Compression format recognized by leading bytes of compressed data.
+    Keeps count of decompressed strings and time spent.
+
+    """
+
+    def __init__(self, name, sniff, decompress):
+        self.name = name
+        self.sniff = sniff
+        self._decompress = decompress
+        self.lock = Lock()
+        self.count = 0
+        self.failures = 0
+        self.time = 0.0
+
+    def decompress(self, s):
+        t0 = time.time()
         try:
-            decompressed = decomp(s)
-        except:
-            pass
-        else:
-            break
-    return decompressed
+            result = self._decompress(s)
+        except Exception, e:
+            with self.lock:
+                self.failures += 1
+            raise DecompressionError(self.name, str(e))
+        t = time.time() - t0
+        with self.lock:
+            self.count += 1
+            self.time += t
+        return result
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+
+def _is_zlib(s):
+    """
+    >>> _is_zlib(zlib.compress('abc')), _is_zlib(bz2.compress('abc'))
+    (True, False)
+    >>> _is_zlib('[]'), _is_zlib('')
+    (False, False)
+
+    Headers with preset dictionary or window larger than 32K are not
+    produced by zlib.compress:
+
+    >>> _is_zlib('\\x88\\x1c'), _is_zlib('\\x78\\xbb')
+    (False, False)
+
+    """
+    if len(s) < 2:
+        return False
+    cmf, flg = ord(s[0]), ord(s[1])
+    return (cmf & 0x0f == 8 and cmf >> 4 <= 7 and not flg & 0x20 and
+            (cmf << 8 | flg) % 31 == 0)
+
+def _is_bz2(s):
+    """
+    >>> _is_bz2(bz2.compress('abc')), _is_bz2(zlib.compress('abc'))
+    (True, False)
+
+    """
+    return s[:3] == 'BZh' and '1' <= s[3:4] <= '9'
+
+def _is_xz(s):
+    return s[:6] == '\xfd7zXZ\x00'
+
+def _xz_decompress(s):
+    if lzma is None:
+        raise ImportError('lzma module is not available')
+    return lzma.decompress(str(s))
+
+codecs = []
+
+def register_codec(codec):
+    """
+    Register codec so that it is tried before codecs registered
+    earlier. Uncompressed data codec is registered first, so it is
+    tried last.
+
+    """
+    codecs.insert(0, codec)
+
+register_codec(Codec('none', lambda s: True, str))
+register_codec(Codec('xz', _is_xz, _xz_decompress))
+register_codec(Codec('bz2', _is_bz2, bz2.decompress))
+register_codec(Codec('zlib', _is_zlib, zlib.decompress))
+
+def find_codec(s):
+    for codec in codecs:
+        if codec.sniff(s):
+            return codec
+
+def decompress(s):
+    """
+    >>> decompress(zlib.compress('abc')), decompress(bz2.compress('abc'))
+    ('abc', 'abc')
+    >>> decompress(buffer('[1, 2]'))
+    '[1, 2]'
+
+    Corrupt data raises DecompressionError rather than coming back
+    still compressed:
+
+    >>> decompress(zlib.compress('[1, 2]')[:-3]) #doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    DecompressionError: Failed to decompress zlib data: ...
+
+    """
+    return find_codec(s).decompress(s)
 
 
 def _collators():
@@ -172,6 +475,22 @@ def cmp_word_exact(word1, word2, strength):
     return k1.compareTo(k2)
 
 
+def fold(word):
+    """
+    Lower case word with accents and other combining marks removed,
+    approximating comparison at PRIMARY strength.
+
+    >>> fold('Ábc'.decode('utf8'))
+    u'abc'
+    >>> fold(u'\ufb01le')
+    u'file'
+
+    """
+    decomposed = unicodedata.normalize('NFKD', word)
+    return u''.join([c for c in decomposed
+                     if not unicodedata.combining(c)]).lower()
+
+
 def split_word(word):
     """
     >>> split_word(u'a#b')
@@ -198,14 +517,208 @@ def split_word(word):
     return lookupword, section
 
 
-class CacheList(local):
+def is_glob(word):
+    """
+    >>> is_glob(u'hydro*ide'), is_glob(u'?ell'), is_glob(u'hydrogen')
+    (True, True, False)
+
+    """
+    return u'*' in word or u'?' in word
+
+
+def glob_prefix(pattern):
+    """
+    Literal part of glob pattern before the first wildcard.
+
+    >>> glob_prefix(u'hydro*ide')
+    u'hydro'
+    >>> glob_prefix(u'?ell')
+    u''
+
+    """
+    return re.split(u'[*?]', pattern, 1)[0]
+
+
+def glob_re(pattern):
+    """
+    Compile glob pattern with * (any characters) and ? (any one
+    character) into regular expression matching whole folded titles.
+
+    >>> glob_re(u'Hydro*ide').match(fold(u'hydroxide')) is not None
+    True
+    >>> glob_re(u'?ell').match(fold(u'Bell')) is not None
+    True
+    >>> glob_re(u'?ell').match(fold(u'cells')) is not None
+    False
+
+    """
+    parts = []
+    for c in fold(pattern):
+        if c == u'*':
+            parts.append(u'.*')
+        elif c == u'?':
+            parts.append(u'.')
+        else:
+            parts.append(re.escape(c))
+    return re.compile(u''.join(parts) + u'\\Z', re.UNICODE | re.DOTALL)
+
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache bounded by number of entries
+    and, optionally, by total size of values as measured by sizeof.
+
+    >>> c = LRUCache(max_size=2)
+    >>> c.put('a', 1)
+    >>> c.put('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.put('c', 3)
+    >>> c.get('b') is None, c.get('a'), c.get('c')
+    (True, 1, 3)
+    >>> c.hit, c.miss, c.evictions
+    (3, 1, 1)
+
+    >>> c = LRUCache(max_size=10, max_bytes=5)
+    >>> c.put('a', 'abc')
+    >>> c.put('b', 'de')
+    >>> c.put('c', 'f')
+    >>> sorted(c.keys()), c.size
+    (['b', 'c'], 3)
+
+    """
+
+    #Entries are kept in a circular doubly linked list of
+    #[prev, next, key, value, size] links, most recently used last
+
+    def __init__(self, max_size=1000, max_bytes=None, sizeof=len, name=''):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.name = name
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.map = {}
+            root = self.root = []
+            root[:] = [root, root, None, None, 0]
+            self.size = 0
+            self.hit = 0
+            self.miss = 0
+            self.evictions = 0
 
-    def __init__(self, alist, name=''):
-        super(CacheList, self).__init__(self)
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def keys(self):
+        return self.map.keys()
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.map.get(key)
+            if link is None:
+                self.miss += 1
+                return default
+            self.hit += 1
+            link_prev, link_next = link[0], link[1]
+            link_prev[1] = link_next
+            link_next[0] = link_prev
+            root = self.root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return link[3]
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self.lock:
+            if key in self.map:
+                self._remove(self.map[key])
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            root = self.root
+            last = root[0]
+            link = [last, root, key, value, size]
+            last[1] = root[0] = self.map[key] = link
+            self.size += size
+            while (len(self.map) > self.max_size or
+                   (self.max_bytes is not None and self.size > self.max_bytes)):
+                self._remove(root[1])
+                self.evictions += 1
+
+    def resize(self, max_size, max_bytes=None):
+        """
+        Change limits, evicting least recently used entries that do
+        not fit new ones.
+
+        >>> c = LRUCache(max_size=3)
+        >>> for key in 'abc': c.put(key, key)
+        >>> c.resize(max_size=3, max_bytes=2)
+        >>> sorted(c.keys()), c.evictions
+        (['b', 'c'], 1)
+
+        """
+        with self.lock:
+            if max_bytes is not None and self.max_bytes is None:
+                #sizes were not measured while there was no byte limit
+                for link in self.map.itervalues():
+                    link[4] = self.sizeof(link[3])
+                self.size = sum(link[4] for link in self.map.itervalues())
+            self.max_size = max_size
+            self.max_bytes = max_bytes
+            root = self.root
+            while self.map and (len(self.map) > self.max_size or
+                                (self.max_bytes is not None and
+                                 self.size > self.max_bytes)):
+                self._remove(root[1])
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.map:
+                self._remove(self.map[key])
+
+    def _remove(self, link):
+        link_prev, link_next = link[0], link[1]
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+        del self.map[link[2]]
+        self.size -= link[4]
+
+
+class CacheList(object):
+    """
+    Read-through cache for items of an indexable list, shared
+    by all threads accessing the list. Size of cached items is
+    measured in bytes of memory they take, max_bytes of None means
+    word_cache_bytes and 0 means no byte limit.
+
+    >>> c = CacheList([u'a', u'b'], max_bytes=0)
+    >>> c[1], c.cache.max_bytes
+    (u'b', None)
+    >>> c = CacheList([u'a', u'b'], max_bytes=sys.getsizeof(u'a'))
+    >>> c[0], c[1], c.cache.keys()
+    (u'a', u'b', [1])
+
+    """
+
+    def __init__(self, alist, name='', max_size=None, max_bytes=None):
         self.alist = alist
-        self.cache = {}
-        self.hit = 0
-        self.miss = 0
+        if max_bytes is None:
+            max_bytes = word_cache_bytes
+        self.cache = LRUCache(max_size=max_size or word_cache_size,
+                              max_bytes=max_bytes or None,
+                              sizeof=sys.getsizeof,
+                              name=name)
         self.name = name
 
     def __len__(self):
@@ -213,13 +726,173 @@ class CacheList(local):
 
     def __getitem__(self, i):
         c = self.cache
-        if i not in c:
-            c[i] = r = self.alist[i]
-            # self.miss += 1
-            return r
+        r = c.get(i, _missing)
+        if r is _missing:
+            r = self.alist[i]
+            c.put(i, r)
+        return r
+
+
+def _deep_sizeof(obj):
+    """
+    Memory taken by obj along with items of lists, tuples and dicts
+    it contains.
+
+    >>> meta = {u'r': u'abc'}
+    >>> _deep_sizeof(meta) - sys.getsizeof(meta) == (sys.getsizeof(u'r') +
+    ...                                              sys.getsizeof(u'abc'))
+    True
+
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += _deep_sizeof(key) + _deep_sizeof(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += _deep_sizeof(item)
+    return size
+
+def _article_size(value):
+    text, meta = value
+    return sys.getsizeof(text) + _deep_sizeof(meta)
+
+#Decoded articles as (text, meta) tuples, shared by all volumes and
+#keyed by (volume_id, article pointer) so that entries pointing to the
+#same article share one copy
+article_cache = LRUCache(max_size=article_cache_size,
+                         max_bytes=article_cache_bytes,
+                         sizeof=_article_size,
+                         name='articles')
+
+def configure_article_cache(max_bytes=None, max_size=None):
+    """
+    Set memory budget of article cache in bytes and, optionally,
+    maximum number of cached articles. Arguments of None keep
+    current values, max_bytes of 0 means no byte limit.
+
+    """
+    global article_cache_size, article_cache_bytes
+    if max_bytes is not None:
+        article_cache_bytes = max_bytes
+    if max_size is not None:
+        article_cache_size = max_size
+    article_cache.resize(article_cache_size, article_cache_bytes or None)
+
+#Decompressed article blocks of version 2 volumes, keyed by
+#(volume_id, block pointer), so that reading articles next to each
+#other decompresses their block once
+block_cache = LRUCache(max_size=block_cache_size,
+                       max_bytes=block_cache_bytes,
+                       name='blocks')
+
+
+index1_chunk_size = 10000
+
+_uint32_typecode = [t for t in 'ILH' if array(t).itemsize == 4][0]
+
+
+def uint32_array(data=''):
+    """
+    Array of unsigned 32 bit integers stored big-endian in data,
+    empty array to append to if data is not given.
+
+    >>> a = uint32_array('\\x00\\x00\\x00\\x01\\x00\\x00\\x01\\x00')
+    >>> a == array('I', [1, 256])
+    True
+
+    """
+    a = array(_uint32_typecode)
+    a.fromstring(data)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a
+
+
+def uint32_string(a):
+    """
+    Big-endian representation of array a of unsigned 32 bit integers.
+
+    >>> uint32_string(uint32_array('\\x00\\x00\\x00\\x01'))
+    '\\x00\\x00\\x00\\x01'
+
+    """
+    if sys.byteorder == 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tostring()
+
+
+class Index1(object):
+    """
+    Table of (key pointer, article pointer) items, read in place from
+    mapped volume file.
+
+    """
+
+    def __init__(self, fmap, offset, length, item_format):
+        self.fmap = fmap
+        self.offset = offset
+        self.length = length
+        self.item_format = item_format.rstrip('\0')
+        self.item_size = calcsize(self.item_format)
+        self.width = len(self.item_format.lstrip('<>!=@'))
+        self.uint32 = (self.item_format[0] in '>!' and
+                       self.item_format[1:] == 'L'*self.width)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if 0 <= i < self.length:
+            return unpack_from(self.item_format, self.fmap,
+                               self.offset + i*self.item_size)
         else:
-            # self.hit += 1
-            return c[i]
+            raise IndexError
+
+    def key_pointer(self, i):
+        if 0 <= i < self.length:
+            return unpack_from(self.item_format, self.fmap,
+                               self.offset + i*self.item_size)[0]
+        raise IndexError
+
+    def article_pointer(self, i):
+        """
+        Article pointer of i-th item, or (block pointer, offset in
+        block) for items of block compressed volumes.
+
+        """
+        if 0 <= i < self.length:
+            item = unpack_from(self.item_format, self.fmap,
+                               self.offset + i*self.item_size)
+            return item[1] if self.width == 2 else item[1:]
+        raise IndexError
+
+    def pointers(self, start=0, end=None):
+        """
+        Return key pointers and article (or block) pointers of items
+        start to end as two sequences. With NumPy these are views of
+        the mapped table, otherwise arrays decoded from it in one step.
+
+        """
+        if end is None or end > self.length:
+            end = self.length
+        start = min(start, end)
+        pos = self.offset + start*self.item_size
+        count = end - start
+        if not self.uint32:
+            items = [self[i] for i in xrange(start, end)]
+            return [item[0] for item in items], [item[1] for item in items]
+        if numpy is not None:
+            table = numpy.frombuffer(self.fmap, dtype='>u4',
+                                     count=count*self.width, offset=pos)
+            table = table.reshape(count, self.width)
+            return table[:, 0], table[:, 1]
+        table = array(_uint32_typecode)
+        table.fromstring(self.fmap[pos:pos + count*self.item_size])
+        if sys.byteorder == 'little':
+            table.byteswap()
+        return table[0::self.width], table[1::self.width]
 
 
 class WordList(object):
@@ -228,21 +901,30 @@ class WordList(object):
 
     """
 
-    def __init__(self, length, read_index_item, read_key):
-        self.length = length
-        self.read_index_item = read_index_item
+    def __init__(self, index1, read_key):
+        self.length = len(index1)
+        self.index1 = index1
         self.read_key = read_key
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, i):
-        if 0 <= i < len(self):
-            key_pos = self.read_index_item(i)[0]
-            key = self.read_key(key_pos)
-            return key.decode('utf8')
-        else:
-            raise IndexError
+        return self.raw(i).decode('utf8')
+
+    def raw(self, i):
+        """
+        UTF-8 encoded i-th word, as stored in the volume.
+
+        """
+        return self.read_key(self.index1.key_pointer(i))
+
+    def __iter__(self):
+        for start in xrange(0, self.length, index1_chunk_size):
+            key_pointers, _ = self.index1.pointers(start,
+                                                   start + index1_chunk_size)
+            for key_pos in key_pointers:
+                yield self.read_key(int(key_pos)).decode('utf8')
 
 
 class CollationKeyList(object):
@@ -265,34 +947,356 @@ class CollationKeyList(object):
         return key.getByteArray()
 
 
-class ArticleList(object):
+def gallop_left(a, x, lo=0):
+    """
+    Same as bisect_left(a, x, lo), but probes positions lo+1, lo+2,
+    lo+4, lo+8... before bisecting, so cost depends on distance from lo
+    rather than on length of a.
+
+    >>> a = [1, 2, 2, 3, 5, 8, 13, 21]
+    >>> [gallop_left(a, x) for x in (0, 2, 4, 21, 22)]
+    [0, 1, 4, 7, 8]
+    >>> gallop_left(a, 13, 4)
+    6
+
+    """
+    n = len(a)
+    if lo >= n or not a[lo] < x:
+        return lo
+    step = 1
+    prev = lo
+    hi = lo + step
+    while hi < n and a[hi] < x:
+        prev = hi
+        step *= 2
+        hi = lo + step
+    return bisect_left(a, x, prev + 1, min(hi, n))
+
+
+def sort_by_key(words, strength, lookup_word=None):
+    """
+    Return list of (collation key, word) for words in collation order.
+    Keys are made from lookup_word(word) if lookup_word is specified.
+
+    """
+    key_func = _collators[strength]
+    if lookup_word is None:
+        return sorted((key_func(word).getByteArray(), word) for word in words)
+    return sorted((key_func(lookup_word(word)).getByteArray(), word)
+                  for word in words)
+
+
+class PrefixKeyList(object):
+    """
+    List of collation keys of specified strength for
+    the first length characters of each word in the word list.
 
-    def __init__(self, length, read_index_item, read_key, read_article):
+    """
+
+    def __init__(self, wordlist, strength, length):
+        self.wordlist = wordlist
+        self.key_func = _collators[strength]
+        self.length = length
+
+    def __len__(self):
+        return len(self.wordlist)
+
+    def __getitem__(self, i):
+        word = self.wordlist[i][:self.length]
+        return self.key_func(word).getByteArray()
+
+
+class SortKeyList(object):
+    """
+    List of precomputed collation keys of one strength, read from
+    sort key index file.
+
+    """
+
+    def __init__(self, fmap, offsets_pos, data_pos, length):
+        self.fmap = fmap
+        self.offsets_pos = offsets_pos
+        self.data_pos = data_pos
         self.length = length
-        self.read_index_item = read_index_item
-        self.read_key = read_key
-        self.read_article = read_article
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, i):
-        if 0 <= i < len(self):
-            _, article_unit_ptr = self.read_index_item(i)
-            return self.read_article(article_unit_ptr)
+        if 0 <= i < self.length:
+            start, end = unpack_from('>LL', self.fmap, self.offsets_pos + 4*i)
+            return self.fmap[self.data_pos+start:self.data_pos+end]
         else:
             raise IndexError
 
 
+SORT_KEY_INDEX_SPEC = (('signature',     '>4s'), # string 'aark'
+                       ('version',       '>H'), # format version, current value 1
+                       ('icu_version',   '>16s'), # ICU version keys were made with
+                       ('index_count',   '>L'), # must match volume's index count
+                       ('primary',       '>Q'), # offset of PRIMARY keys section
+                       ('secondary',     '>Q'), # offset of SECONDARY keys section
+                       ('tertiary',      '>Q'), # offset of TERTIARY keys section
+                       )
+
+sort_key_strengths = ((PRIMARY, 'primary'),
+                      (SECONDARY, 'secondary'),
+                      (TERTIARY, 'tertiary'))
+
+
+class SortKeyIndex(object):
+    """
+    Collation keys of all words in a volume, stored in a file next to
+    other volume indexes keyed by volume's sha1sum. Each strength
+    section is a table of index_count+1 key offsets followed by key data,
+    so bisecting the volume needs no ICU calls.
+
+    """
+
+    ext = '.keys'
+    signature = 'aark'
+    version = 1
+    description = 'sort key index'
+
+    def __init__(self, file_name, index_count):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            header = read_index_header(f, SORT_KEY_INDEX_SPEC, self,
+                                       index_count)
+            if header['icu_version'].rstrip('\0') != ICU_VERSION:
+                raise DictFormatError(file_name,
+                                      'Sort keys were created with different '
+                                      'ICU version')
+            self.fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys = {}
+        offsets_size = 4*(index_count + 1)
+        for strength, name in sort_key_strengths:
+            pos = header[name]
+            self.keys[strength] = SortKeyList(self.fmap, pos,
+                                              pos + offsets_size, index_count)
+
+    @classmethod
+    def build(cls, file_name, words):
+        """
+        Write collation keys for all words in the list to file_name,
+        yielding progress as it goes. Keys are accumulated in temporary
+        files, so memory use does not depend on word list size.
+
+        """
+        count = len(words)
+        key_funcs = [_collators[strength] for strength, _ in sort_key_strengths]
+        offsets = [tempfile.TemporaryFile() for _ in key_funcs]
+        data = [tempfile.TemporaryFile() for _ in key_funcs]
+        try:
+            positions = [0]*len(key_funcs)
+            for f in offsets:
+                f.write(pack('>L', 0))
+            for i, word in enumerate(words):
+                for j, key_func in enumerate(key_funcs):
+                    key = key_func(word).getByteArray()
+                    data[j].write(key)
+                    positions[j] += len(key)
+                    offsets[j].write(pack('>L', positions[j]))
+                if i % 10000 == 0:
+                    yield float(i)/count
+            header_len = spec_len(SORT_KEY_INDEX_SPEC)
+            section_pos = []
+            pos = header_len
+            for j in range(len(key_funcs)):
+                section_pos.append(pos)
+                pos += 4*(count + 1) + positions[j]
+            with atomic_write(file_name) as out:
+                out.write(pack('>4sH16sL', cls.signature, cls.version,
+                               ICU_VERSION, count))
+                for pos in section_pos:
+                    out.write(pack('>Q', pos))
+                for j in range(len(key_funcs)):
+                    for f in (offsets[j], data[j]):
+                        f.seek(0)
+                        shutil.copyfileobj(f, out)
+        finally:
+            for f in offsets + data:
+                f.close()
+        yield 1.0
+
+    def close(self):
+        self.fmap.close()
+
+
+class ArticleList(object):
+
+    def __init__(self, index1, read_key, read_article):
+        self.length = len(index1)
+        self.index1 = index1
+        self.read_key = read_key
+        self.read_article = read_article
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.read_article(self.pointer(i))
+
+    def pointer(self, i):
+        return self.index1.article_pointer(i)
+
+
+class _PrimaryRange(object):
+    """
+    Words of a volume matching start of lookup word at PRIMARY strength.
+    Range start is found with one bisect, collation keys of words in the
+    range are computed at most once per strength.
+
+    """
+
+    def __init__(self, volume, word, start=None):
+        self.volume = volume
+        self.word = word
+        self.raw_word = word.encode('utf8')
+        self.length = len(word)
+        self.word_keys = {}
+        self.keys = {}
+        self._start = start
+
+    def word_key(self, strength):
+        key = self.word_keys.get(strength)
+        if key is None:
+            key = _collators[strength](self.word).getByteArray()
+            self.word_keys[strength] = key
+        return key
+
+    def key(self, i, strength, prefix):
+        k = (i, strength, prefix)
+        key = self.keys.get(k)
+        if key is None:
+            if prefix:
+                word = self.volume.words[i][:self.length]
+                key = _collators[strength](word).getByteArray()
+            else:
+                key = self.volume.sort_keys(strength)[i]
+            self.keys[k] = key
+        return key
+
+    def start(self):
+        if self._start is None:
+            self._start = bisect_left(self.volume.sort_keys(PRIMARY),
+                                      self.word_key(PRIMARY))
+        return self._start
+
+    def first(self, strength):
+        """
+        Position bisect would find for the word at this strength,
+        assuming words are sorted. Words between PRIMARY and this
+        position are equal to the word at PRIMARY strength, so only
+        these are stepped over.
+
+        """
+        i = self.start()
+        if strength == PRIMARY:
+            return i
+        target = self.word_key(strength)
+        length = len(self.volume)
+        while i < length and self.key(i, strength, False) < target:
+            i += 1
+        return i
+
+    def in_range(self, i):
+        """
+        Whether start of i-th word, as many characters long as the
+        lookup word, matches it at PRIMARY strength. Words failing
+        this do not match it as prefix at any strength. Exact matches
+        are not limited to such words: expansions and contractions
+        (such as sharp s and ss) make equal words differ in length.
+
+        """
+        return (i < len(self.volume) and
+                self.key(i, PRIMARY, True) == self.word_key(PRIMARY))
+
+    def matches(self, i, strength, prefix):
+        if self.literal_match(i, prefix):
+            return True
+        if prefix:
+            if not self.in_range(i):
+                return False
+        elif i >= len(self.volume):
+            return False
+        return self.key(i, strength, prefix) == self.word_key(strength)
+
+    def literal_match(self, i, prefix):
+        """
+        Whether i-th word starts with (or, if not prefix, is) the
+        lookup word byte for byte. Such words are equal to it at any
+        strength, so checking raw UTF-8 spares decoding and
+        collation.
+
+        """
+        if i >= len(self.volume):
+            return False
+        raw = self.volume.words.alist.raw(i)
+        if prefix:
+            return raw.startswith(self.raw_word)
+        return raw == self.raw_word
+
+
+_volume_ids = []
+
+_volume_handles = {}
+
+_volume_handles_lock = Lock()
+
+def volume_handle(volume_id):
+    """
+    Small integer standing for volume_id, the same for equal ids
+    for the lifetime of the process.
+
+    >>> volume_handle('a'*40) == volume_handle('a'*40)
+    True
+    >>> _volume_ids[volume_handle('b'*40)] == 'b'*40
+    True
+
+    """
+    try:
+        return _volume_handles[volume_id]
+    except KeyError:
+        with _volume_handles_lock:
+            if volume_id not in _volume_handles:
+                _volume_handles[volume_id] = len(_volume_ids)
+                _volume_ids.append(volume_id)
+            return _volume_handles[volume_id]
+
+
 class Entry(object):
+    """
+    Reference to a word in a volume. Volume is kept as interned
+    handle, so comparing and hashing entries does not touch volume id
+    strings.
+
+    >>> Entry('a'*40, 1, u't', u's') == Entry('a'*40, 1, u'x', u's')
+    True
+    >>> Entry('a'*40, 1) == Entry('b'*40, 1)
+    False
+    >>> Entry('b'*40, 1).volume_id == 'b'*40
+    True
+
+    """
+
+    __slots__ = ('handle', 'index', 'title', 'section', 'redirect_from')
 
     def __init__(self, volume_id, index, title=u'', section=u'', redirect_from=None):
-        self.volume_id = volume_id
+        self.handle = volume_handle(volume_id)
         self.index = index
         self.title = title
         self.section = section
         self.redirect_from = redirect_from
 
+    def _get_volume_id(self):
+        return _volume_ids[self.handle]
+
+    def _set_volume_id(self, volume_id):
+        self.handle = volume_handle(volume_id)
+
+    volume_id = property(_get_volume_id, _set_volume_id)
+
     def _orig_title(self):
         current = self
         while current is not None:
@@ -303,12 +1307,12 @@ class Entry(object):
     orig_title = property(_orig_title)
 
     def __eq__(self, other):
-        return (self.volume_id == other.volume_id and
+        return (self.handle == other.handle and
                 self.index == other.index and
                 self.section == other.section)
 
     def __hash__(self):
-        return hash((self.volume_id, self.index, self.section))
+        return hash((self.handle, self.index, self.section))
 
     def __repr__(self):
         return ('%s(%r, %r, %r, %r, %r)' %
@@ -365,22 +1369,65 @@ def spec_len(spec):
     return result
 
 
+def read_spec(f, spec):
+    result = {}
+    for name, fmt in spec:
+        s = f.read(calcsize(fmt))
+        value, = unpack(fmt, s)
+        result[name] = value
+    return result
+
+
+def read_index_header(f, spec, index_class, index_count):
+    """
+    Read header of index_class file f laid out as spec. Raise
+    DictFormatError unless its signature and version are those of
+    index_class and it was built for a volume with index_count
+    words.
+
+    """
+    header = read_spec(f, spec)
+    description = index_class.description
+    if header['signature'] != index_class.signature:
+        raise DictFormatError(f.name, 'Not a %s file' % description)
+    if header['version'] != index_class.version:
+        raise DictFormatError(f.name, '%s version is not supported' %
+                              description.capitalize())
+    if header['index_count'] != index_count:
+        raise DictFormatError(f.name, '%s does not match volume' %
+                              description.capitalize())
+    return header
+
+
 class Volume(object):
 
     def __init__(self, file_name):
 
         self.file_name = file_name
 
-        with open(self.file_name, 'rb') as f:
-            header = self._read_header(f)
+        cached = _cached_volume(self.file_name)
+        if cached is None:
+            with open(self.file_name, 'rb') as f:
+                header = self._read_header(f)
+                self._check_format(header)
+                self._metadata = meta = self._read_meta(f,
+                                                        header['meta_length'])
+            languages = self._languages(meta)
+            article_url = self._find_article_url(meta)
+            _cache_volume(self.file_name, header, meta, languages,
+                          article_url)
+        else:
+            header, meta, languages, article_url = cached
             self._check_format(header)
-            self.metadata = meta = self._read_meta(f, header['meta_length'])
+            self._metadata = None
 
         self.index_count = header['index_count']
         self.volume_id = self.sha1sum = header['sha1sum']
+        self.handle = volume_handle(self.volume_id)
         self.uuid = UUID(bytes=header['uuid'])
         self.volume = header['volume']
         self.total_volumes = header['total_volumes']
+        self.format_version = header['version']
 
         article_offset = header['article_offset']
         index1_offset = spec_len(HEADER_SPEC) + header['meta_length']
@@ -391,19 +1438,7 @@ class Volume(object):
 
         self.article_count = meta.get('article_count', self.index_count)
 
-        self.index_language = meta.get('index_language', '')
-        if isinstance(self.index_language, unicode):
-            self.index_language = self.index_language.encode('utf8')
-        locale_index_language = Locale(self.index_language).getLanguage()
-        if locale_index_language:
-            self.index_language = locale_index_language
-
-        self.article_language = meta.get('article_language', '')
-        if isinstance(self.article_language, unicode):
-            self.article_language = self.index_language.encode('utf8')
-        locale_article_language = Locale(self.index_language).getLanguage()
-        if locale_article_language:
-            self.article_language = locale_article_language
+        self.index_language, self.article_language = languages
 
         self.title = meta.get('title', u'')
         self.version = meta.get('version', u'')
@@ -412,54 +1447,216 @@ class Volume(object):
         self.license = meta.get('license', u'')
         self.source = meta.get('source', u'')
         self.language_links = sorted(meta.get('language_links', []))
+        self.lang = meta.get('lang')
+        self.sitelang = meta.get('sitelang')
 
-        f = open(self.file_name, 'rb')
-        self.fmap = mmap.mmap(f.fileno(),
-                              article_offset,
-                              access=mmap.ACCESS_READ)
-
-        ii_structsize = calcsize(index1_item_format)
-        def read_index_item(itemno):
-            pos = index1_offset + itemno * ii_structsize
-            return unpack(index1_item_format, self.fmap[pos:pos+ii_structsize])
+        with open(self.file_name, 'rb') as f:
+            try:
+                self.fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, OverflowError):
+                #whole file may not fit into address space
+                #on 32-bit systems, map just the indexes then
+                logging.warning('Failed to map %s, reading articles from file',
+                                self, exc_info=1)
+                self.fmap = mmap.mmap(f.fileno(),
+                                      article_offset,
+                                      access=mmap.ACCESS_READ)
+
+        self.index1 = Index1(self.fmap, index1_offset, self.index_count,
+                             index1_item_format)
 
         klen_structsize = calcsize(key_length_format)
         def read_key(pos):
             realpos = index2_offset + pos
             start = realpos+klen_structsize
-            s = self.fmap[realpos:start]
-            strlen = unpack(key_length_format, s)[0]
+            strlen = unpack_from(key_length_format, self.fmap, realpos)[0]
             return self.fmap[start:start+strlen]
 
         alen_structsize = calcsize(article_length_format)
-        def read_article(pos):
-            with open(self.file_name, 'rb') as f:
-                f.seek(article_offset + pos)
-                s = f.read(alen_structsize)
-                strlen = unpack(article_length_format, s)[0]
-                compressed_article = f.read(strlen)
-                return decompress(compressed_article)
-
-        self.words = CacheList(WordList(self.index_count,
-                                        read_index_item,
-                                        read_key),
+        if len(self.fmap) > article_offset:
+            def read_unit(pos):
+                realpos = article_offset + pos
+                strlen = unpack_from(article_length_format, self.fmap, realpos)[0]
+                return decompress(buffer(self.fmap, realpos + alen_structsize,
+                                         strlen))
+        else:
+            def read_unit(pos):
+                with open(self.file_name, 'rb') as f:
+                    f.seek(article_offset + pos)
+                    s = f.read(alen_structsize)
+                    strlen = unpack(article_length_format, s)[0]
+                    compressed_article = f.read(strlen)
+                    return decompress(compressed_article)
+
+        if self.format_version == 1:
+            read_article = read_unit
+        else:
+            def read_article(pos):
+                block_ptr, offset = pos
+                cache_key = (self.volume_id, block_ptr)
+                block = block_cache.get(cache_key)
+                if block is None:
+                    block = read_unit(block_ptr)
+                    block_cache.put(cache_key, block)
+                strlen = unpack_from(article_length_format, block, offset)[0]
+                start = offset + alen_structsize
+                return block[start:start+strlen]
+
+        self.words = CacheList(WordList(self.index1, read_key),
                                name='%s (w)' % format_title(self))
 
-        self.articles = ArticleList(self.index_count,
-                                    read_index_item,
-                                    read_key,
-                                    read_article)
+        self.articles = ArticleList(self.index1, read_key, read_article)
 
         self._interwiki_map = None
-        self._article_url = None
+        self.article_url = article_url
+
+        self.sort_key_index = None
+        self._open_sort_key_index()
+        self._fuzzy_index = None
+        self._fulltext_index = None
+        self._substring_index = None
+        self._block_manifest = None
+
+    def _open_sort_key_index(self):
+        self.sort_key_index = self._open_index(SortKeyIndex)
+
+    def _open_index(self, index_class):
+        file_name = sidecar_path(self.sha1sum, index_class.ext)
+        if os.path.exists(file_name):
+            try:
+                return index_class(file_name, self.index_count)
+            except Exception:
+                logging.warning('Ignoring index %s for %s',
+                                file_name, self, exc_info=1)
+        return None
+
+    def _build_index(self, index_class, *args):
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        file_name = sidecar_path(self.sha1sum, index_class.ext)
+        return index_class.build(file_name, self.words.alist, *args)
+
+    def build_sort_key_index(self):
+        if self.sort_key_index:
+            self.sort_key_index.close()
+            self.sort_key_index = None
+        for progress in self._build_index(SortKeyIndex):
+            yield progress
+        self._open_sort_key_index()
+
+    def _get_fuzzy_index(self):
+        if self._fuzzy_index is None:
+            from aarddict.fuzzy import FuzzyIndex
+            self._fuzzy_index = self._open_index(FuzzyIndex) or False
+        return self._fuzzy_index or None
+
+    fuzzy_index = property(_get_fuzzy_index)
+
+    def build_fuzzy_index(self):
+        from aarddict.fuzzy import FuzzyIndex
+        if self._fuzzy_index:
+            self._fuzzy_index.close()
+        self._fuzzy_index = None
+        return self._build_index(FuzzyIndex)
+
+    def fuzzy_lookup(self, word, max_distance=2, limit=10):
+        """
+        Return up to limit entries with titles within max_distance
+        edits of word, closest first, ignoring case and accents.
+        Short words allow fewer edits (see fuzzy.allowed_distance).
+        Volumes without fuzzy index have no fuzzy matches.
+
+        """
+        return [entry for _, entry in
+                self._fuzzy_matches(word, max_distance, limit)]
+
+    def _fuzzy_matches(self, word, max_distance, limit):
+        word, _ = split_word(word)
+        if not word or not self.fuzzy_index:
+            return []
+        return [(distance, self._entry(i)) for distance, i in
+                self.fuzzy_index.lookup(self.words, word, max_distance, limit)]
+
+    def _get_fulltext_index(self):
+        if self._fulltext_index is None:
+            from aarddict.fulltext import FullTextIndex
+            self._fulltext_index = self._open_index(FullTextIndex) or False
+        return self._fulltext_index or None
+
+    fulltext_index = property(_get_fulltext_index)
+
+    def build_fulltext_index(self, processes=None):
+        from aarddict.fulltext import FullTextIndex
+        if self._fulltext_index:
+            self._fulltext_index.close()
+        self._fulltext_index = None
+        return self._build_index(FullTextIndex, self.file_name, processes)
+
+    def search_text(self, query, limit=50):
+        """
+        Return up to limit entries whose articles contain all words
+        and quoted phrases of query, best match first. Volumes without
+        full-text index have no matches.
+
+        """
+        return [entry for _, entry in self._search_text(query, limit)]
+
+    def _search_text(self, query, limit):
+        if not self.fulltext_index:
+            return []
+        return [(score, self._entry(i)) for score, i in
+                self.fulltext_index.search(query, limit)]
+
+    def _get_substring_index(self):
+        if self._substring_index is None:
+            from aarddict.substring import SubstringIndex
+            self._substring_index = self._open_index(SubstringIndex) or False
+        return self._substring_index or None
+
+    substring_index = property(_get_substring_index)
+
+    def build_substring_index(self):
+        from aarddict.substring import SubstringIndex
+        if self._substring_index:
+            self._substring_index.close()
+        self._substring_index = None
+        return self._build_index(SubstringIndex)
+
+    def search_substring(self, word):
+        """
+        Generate entries whose titles contain word, ignoring case and
+        accents. Volumes without substring index are scanned.
+
+        """
+        if self.substring_index:
+            indexes = self.substring_index.search(word)
+        else:
+            indexes = self._scan_substring(word)
+        for index in indexes:
+            yield self._entry(index)
+
+    def _scan_substring(self, word):
+        key = fold(word)
+        if not key:
+            return
+        for index in xrange(len(self)):
+            title, _ = split_word(self.words[index])
+            if key in fold(title):
+                yield index
+
+    def _entry(self, index):
+        matched_word = self.words[index]
+        _, section = split_word(matched_word)
+        return Entry(self.volume_id, index, matched_word, section=section)
+
+    def sort_keys(self, strength):
+        if self.sort_key_index:
+            return self.sort_key_index.keys[strength]
+        return CollationKeyList(self.words, strength)
 
     def _read_header(self, f):
-        header = {}
         try:
-            for name, fmt in HEADER_SPEC:
-                s = f.read(calcsize(fmt))
-                value, = unpack(fmt, s)
-                header[name] = value
+            header = read_spec(f, HEADER_SPEC)
         except:
             logging.exception('Failed to read dictionary header from %s',
                               self.file_name)
@@ -472,7 +1669,7 @@ class Volume(object):
         if header['signature'] != 'aard':
             raise DictFormatError(self.file_name,
                                   'Not a recognized aarddict dictionary file')
-        if header['version'] != 1:
+        if header['version'] not in format_versions:
             raise DictFormatError(self.file_name,
                                   'File format version is not compatible with this viewer')
 
@@ -480,6 +1677,31 @@ class Volume(object):
         raw_meta = f.read(meta_length)
         return simplejson.loads(decompress(raw_meta))
 
+    def _languages(self, meta):
+        index_language = meta.get('index_language', '')
+        if isinstance(index_language, unicode):
+            index_language = index_language.encode('utf8')
+        locale_index_language = Locale(index_language).getLanguage()
+        if locale_index_language:
+            index_language = locale_index_language
+
+        article_language = meta.get('article_language', '')
+        if isinstance(article_language, unicode):
+            article_language = index_language.encode('utf8')
+        locale_article_language = Locale(index_language).getLanguage()
+        if locale_article_language:
+            article_language = locale_article_language
+        return index_language, article_language
+
+    def _get_metadata(self):
+        if self._metadata is None:
+            with open(self.file_name, 'rb') as f:
+                header = self._read_header(f)
+                self._metadata = self._read_meta(f, header['meta_length'])
+        return self._metadata
+
+    metadata = property(_get_metadata)
+
     def __len__(self):
         return self.index_count
 
@@ -508,9 +1730,107 @@ class Volume(object):
 
     def lookup(self, word, strength=PRIMARY, cmp_func=cmp_word_start):
         if not word:
-            raise StopIteration
-        index = bisect_left(CollationKeyList(self.words, strength),
-                            collation_key(word, strength).getByteArray())
+            return iter(())
+        return self._lookup_from(self.position(word, strength),
+                                 word, strength, cmp_func)
+
+    def glob(self, pattern, cancelled=None):
+        """
+        Generate entries whose titles match glob pattern, ignoring case
+        and accents. If pattern starts with literal text, only words
+        in its PRIMARY prefix range are checked, otherwise all words
+        are scanned in chunks. Scan stops early once optional
+        cancelled callable returns True.
+
+        """
+        regex = glob_re(pattern)
+        prefix = glob_prefix(pattern)
+        if prefix:
+            candidates = (entry.index for entry in self.lookup(prefix))
+        else:
+            candidates = self._scan_chunks(cancelled)
+        for n, index in enumerate(candidates):
+            if cancelled and n % glob_chunk_size == 0 and cancelled():
+                return
+            #scan reads words past the cache so as not to flush it
+            title, _ = split_word(self.words.alist[index])
+            if regex.match(fold(title)):
+                yield self._entry(index)
+
+    def _scan_chunks(self, cancelled):
+        for start in xrange(0, len(self), glob_chunk_size):
+            if cancelled and cancelled():
+                return
+            for index in xrange(start, min(len(self),
+                                           start + glob_chunk_size)):
+                yield index
+
+    def position(self, word, strength=PRIMARY):
+        """
+        Index of the first word not less than word at given strength.
+
+        """
+        return bisect_left(self.sort_keys(strength),
+                           collation_key(word, strength).getByteArray())
+
+    def count(self, word, strength=PRIMARY, cmp_func=cmp_word_start):
+        """
+        Number of entries lookup() would yield, without reading words
+        or making entries. Exact matches form a contiguous range of
+        sorted keys, so they are counted with two bisects. Prefix
+        matches are counted by comparing prefix keys from the first
+        bisect on, like lookup() does: prefixes of sorted words are not
+        necessarily sorted (sharp s sorts as ss, for example), so the
+        end of the range can not be found with a bisect.
+
+        """
+        if not word:
+            return 0
+        key = collation_key(word, strength).getByteArray()
+        keys = self.sort_keys(strength)
+        lo = bisect_left(keys, key)
+        if cmp_func is cmp_word_exact:
+            return bisect_right(keys, key, lo) - lo
+        elif cmp_func is cmp_word_start:
+            prefix_keys = PrefixKeyList(self.words, strength, len(word))
+            hi = lo
+            while hi < len(prefix_keys) and prefix_keys[hi] == key:
+                hi += 1
+            return hi - lo
+        else:
+            raise ValueError('Can only count matches for %s or %s' %
+                             (cmp_word_exact.__name__, cmp_word_start.__name__))
+
+    def lookup_many(self, words, strength=PRIMARY, cmp_func=cmp_word_start):
+        """
+        Look up each of words like lookup() does, generating
+        (word, entries) tuples in collation order of words. Index
+        positions are found by galloping forward from the previous
+        word's position instead of bisecting the whole index again.
+
+        """
+        keys = self.sort_keys(strength)
+        index = 0
+        for key, word in sort_by_key(words, strength):
+            if not word:
+                yield word, []
+                continue
+            index = gallop_left(keys, key, index)
+            yield word, list(self._lookup_from(index, word, strength, cmp_func))
+
+    def primary_positions(self, keys):
+        """
+        Generate PRIMARY bisect position for each of collation keys,
+        which must be sorted.
+
+        """
+        sort_keys = self.sort_keys(PRIMARY)
+        index = 0
+        for key in keys:
+            index = gallop_left(sort_keys, key, index)
+            yield index
+
+    def _lookup_from(self, index, word, strength, cmp_func):
         try:
             while True:
                 matched_word = self.words[index]
@@ -527,11 +1847,58 @@ class Volume(object):
         except IndexError:
             raise StopIteration
 
+    def lookup_tiers(self, word, comparisons, start=None):
+        """
+        Return a generator for each (cmp_func, strength) comparison,
+        producing same entries as lookup() would, but sharing one
+        PRIMARY bisect and collation keys of words in its range.
+        PRIMARY bisect position may be passed in as start if already
+        known.
+
+        """
+        candidates = _PrimaryRange(self, word, start)
+        return [self._lookup_tier(candidates, strength, cmp_func)
+                for cmp_func, strength in comparisons]
+
+    def _lookup_tier(self, candidates, strength, cmp_func):
+        word = candidates.word
+        if not word:
+            return
+        if cmp_func is cmp_word_start:
+            prefix = True
+        elif cmp_func is cmp_word_exact:
+            prefix = False
+        else:
+            for entry in self.lookup(word, strength, cmp_func):
+                yield entry
+            return
+        index = candidates.first(strength)
+        while candidates.matches(index, strength, prefix):
+            matched_word = self.words[index]
+            _, section = split_word(matched_word)
+            yield Entry(self.volume_id, index,
+                        matched_word, section=section)
+            index += 1
+
     def read(self, entry):
-        if entry.volume_id != self.volume_id:
+        if entry.handle != self.handle:
             raise ValueError("Entry is not from this volume")
 
-        serialized_article = self.articles[entry.index]
+        article_unit_ptr = self.articles.pointer(entry.index)
+        cache_key = (self.volume_id, article_unit_ptr)
+        text, meta = article_cache.get(cache_key) or self._load(cache_key)
+
+        redirect = meta.get(u'r', meta.get('redirect', u''))
+        if redirect and entry.section:
+            redirect = u'#'.join((redirect, entry.section))
+
+        if redirect:
+            return Redirect(entry, redirect)
+        else:
+            return Article(entry, text)
+
+    def _load(self, cache_key):
+        serialized_article = self.articles.read_article(cache_key[1])
 
         try:
             articletuple = simplejson.loads(serialized_article)
@@ -545,14 +1912,8 @@ class Volume(object):
                               serialized_article[:20])
             raise
         else:
-            redirect = meta.get(u'r', meta.get('redirect', u''))
-            if redirect and entry.section:
-                redirect = u'#'.join((redirect, entry.section))
-
-            if redirect:
-                return Redirect(entry, redirect)
-            else:
-                return Article(entry, text)
+            article_cache.put(cache_key, (text, meta))
+            return text, meta
 
     def _get_interwiki_map(self):
         if self._interwiki_map is None:
@@ -566,29 +1927,106 @@ class Volume(object):
 
     interwiki_map = property(_get_interwiki_map)
 
-    def _get_article_url(self):
-        if self._article_url is None:
-            self._article_url = u''
-            if 'siteinfo' in self.metadata:
-                siteinfo = self.metadata['siteinfo']
-                try:
-                    general = siteinfo['general']
-                    server = general['server']
-                    articlepath = general['articlepath']
-                except KeyError:
-                    logging.debug('Site info for %s is incomplete', self)
-                else:
-                    self._article_url = ''.join((server, articlepath))
+    def _find_article_url(self, meta):
+        """
+        Article URL template made from site info in metadata, or
+        Wikipedia URL for volume's language. It is kept in volume
+        cache with metadata summary, so that siteinfo does not need
+        to be read to find volumes by article URL.
+
+        """
+        article_url = u''
+        if 'siteinfo' in meta:
+            siteinfo = meta['siteinfo']
+            try:
+                general = siteinfo['general']
+                server = general['server']
+                articlepath = general['articlepath']
+            except KeyError:
+                logging.debug('Site info for %s is incomplete', self)
             else:
-                logging.debug('No site info in %r', self)
-                if 'lang' in self.metadata and 'sitelang' in self.metadata:
-                    self._article_url = u'http://%s.wikipedia.org/wiki/$1' % self.metadata['lang']
-                    logging.debug('Using fallback url based on lang: %r', self._article_url)
-        return self._article_url
-
-    article_url = property(_get_article_url)
+                article_url = ''.join((server, articlepath))
+        else:
+            logging.debug('No site info in %r', self)
+            if 'lang' in meta and 'sitelang' in meta:
+                article_url = u'http://%s.wikipedia.org/wiki/$1' % meta['lang']
+                logging.debug('Using fallback url based on lang: %r', article_url)
+        return article_url
+
+    def _get_block_manifest(self):
+        if self._block_manifest is None:
+            from aarddict.blocks import BlockManifest
+            self._block_manifest = self._open_index(BlockManifest) or False
+        return self._block_manifest or None
+
+    block_manifest = property(_get_block_manifest)
+
+    def build_block_manifest(self, block_size=None):
+        from aarddict.blocks import BlockManifest
+        self._block_manifest = None
+        return self._build_index(BlockManifest, self.file_name, self.sha1sum,
+                                 spec_len(HEADER_SPEC[:2]), block_size)
+
+    def verified(self):
+        """
+        True or False if volume was verified before and its file has
+        not changed since, None otherwise.
+
+        """
+        cached = self._cached_verification()
+        return None if cached is None else cached['ok']
+
+    def _cached_verification(self):
+        cached = _read_verify_cache().get(os.path.abspath(self.file_name))
+        if (cached and
+            cached.get('identity') == _file_identity(self.file_name,
+                                                     self.sha1sum)):
+            return cached
+        return None
 
-    def verify(self):
+    def verify(self, executor=None, force=False):
+        """
+        Check volume content against its sha1sum, yielding
+        progress. With block manifest blocks are checked in parallel
+        by executor, interrupted verification resumes where it stopped
+        and VerifyError lists corrupt byte ranges. Outcome is
+        remembered, unchanged volume is not read again unless force is
+        True.
+
+        """
+        if not force:
+            cached = self._cached_verification()
+            if cached is not None:
+                return self._replay_verification(cached)
+        return self._record_verification(self._verify(executor))
+
+    def _replay_verification(self, cached):
+        yield 1.0
+        if not cached['ok']:
+            raise VerifyError(tuple(r) for r in cached['corrupt_ranges'])
+
+    def _record_verification(self, progress):
+        identity = _file_identity(self.file_name, self.sha1sum)
+        try:
+            for value in progress:
+                yield value
+        except VerifyError, e:
+            _update_verify_cache(self.file_name, identity, False,
+                                 e.corrupt_ranges)
+            raise
+        else:
+            _update_verify_cache(self.file_name, identity, True)
+
+    def _verify(self, executor):
+        manifest = self.block_manifest
+        if manifest:
+            from aarddict import blocks
+            return manifest.verify(self.file_name,
+                                   executor or blocks.pool(),
+                                   sidecar_path(self.sha1sum, '.verifying'))
+        return self._verify_sha1()
+
+    def _verify_sha1(self):
         st_size = os.stat(self.file_name).st_size
         offset = spec_len(HEADER_SPEC[:2])
         size = float(st_size - offset)
@@ -600,6 +2038,14 @@ class Volume(object):
 
     def close(self):
         self.fmap.close()
+        if self.sort_key_index:
+            self.sort_key_index.close()
+        if self._fuzzy_index:
+            self._fuzzy_index.close()
+        if self._fulltext_index:
+            self._fulltext_index.close()
+        if self._substring_index:
+            self._substring_index.close()
 
 
 class DictFormatError(Exception):
@@ -613,7 +2059,26 @@ class DictFormatError(Exception):
         return '%s: %s' % (self.file_name, self.reason)
 
 
-class VerifyError(Exception): pass
+class VerifyError(Exception):
+
+    def __init__(self, corrupt_ranges=()):
+        Exception.__init__(self)
+        self.corrupt_ranges = list(corrupt_ranges)
+
+    def __str__(self):
+        return ', '.join('%d-%d' % r for r in self.corrupt_ranges)
+
+
+class DecompressionError(Exception):
+
+    def __init__(self, codec_name, reason):
+        Exception.__init__(self, codec_name, reason)
+        self.codec_name = codec_name
+        self.reason = reason
+
+    def __str__(self):
+        return 'Failed to decompress %s data: %s' % (self.codec_name,
+                                                    self.reason)
 
 
 class ArticleNotFound(Exception):
@@ -630,8 +2095,166 @@ class TooManyRedirects(Exception):
         self.entry = entry
 
 
+def _in_ranges(i, ranges):
+    for lo, hi in ranges:
+        if lo <= i < hi:
+            return True
+    return False
+
+def _encode_cursor(state):
+    return base64.urlsafe_b64encode(zlib.compress(simplejson.dumps(state)))
+
+def _decode_cursor(cursor):
+    try:
+        return simplejson.loads(zlib.decompress(
+                base64.urlsafe_b64decode(str(cursor))))
+    except Exception:
+        raise ValueError('Invalid cursor %r' % cursor)
+
+
+def _invalidating(name):
+    method = getattr(list, name)
+    def f(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._invalidate()
+    f.__name__ = name
+    return f
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 2
+
+
+class Task(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.finished = Event()
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            if not self.cancelled:
+                self.result = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        self.finished.set()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self):
+        self.finished.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class WorkerPool(object):
+    """
+    Fixed number of daemon threads running submitted tasks in order.
+
+    >>> pool = WorkerPool(2)
+    >>> tasks = [pool.submit(pow, i, 2) for i in range(5)]
+    >>> [t.wait() for t in tasks]
+    [0, 1, 4, 9, 16]
+
+    """
+
+    def __init__(self, size=None):
+        self.size = size or cpu_count()
+        self.queue = Queue()
+        self.threads = []
+        self.lock = Lock()
+
+    def submit(self, func, *args):
+        task = Task(func, args)
+        with self.lock:
+            if not self.threads:
+                self._start()
+        self.queue.put(task)
+        return task
+
+    def _start(self):
+        for i in range(self.size):
+            t = Thread(target=self._work, name='WorkerPool-%d' % i)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+        #let threads exit before interpreter shutdown tears down modules
+        atexit.register(self.shutdown)
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            task.run()
+
+    def shutdown(self):
+        with self.lock:
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads = []
+
+
+class _TierStream(object):
+    """
+    Collects per-tier lookup results produced by a worker thread
+    so that they can be consumed, in order, as soon as each tier is
+    complete.
+
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.results = []
+        self.done = False
+        self.cancelled = False
+        self.exc_info = None
+        self.cond = Condition()
+
+    def run(self):
+        try:
+            try:
+                for tier in self.tiers:
+                    if self.cancelled:
+                        break
+                    with self.cond:
+                        self.results.append(tier)
+                        self.cond.notifyAll()
+            except:
+                self.exc_info = sys.exc_info()
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notifyAll()
+
+    def get(self, i):
+        with self.cond:
+            while len(self.results) <= i and not self.done:
+                self.cond.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.results[i] if i < len(self.results) else []
+
+
 class Library(list):
 
+    #WorkerPool for looking up volumes concurrently, if set
+    executor = None
+
     best_match_comparisons = ((cmp_word_exact, TERTIARY),
                               (cmp_word_exact, SECONDARY),
                               (cmp_word_exact, PRIMARY),
@@ -643,42 +2266,229 @@ class Library(list):
                         (cmp_word_exact, SECONDARY),
                         (cmp_word_exact, PRIMARY))
 
+    #volume_id, uuid and article_url indexes, rebuilt on first access
+    #after the list is modified
+    _catalog = None
+    _version = 0
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        #(volume_id, index, section) of redirect -> target entry
+        #attributes or None if redirect target was not found, cleared
+        #whenever the list is modified
+        self.redirect_cache = LRUCache(max_size=redirect_cache_size,
+                                       name='redirects')
+
+    def _invalidate(self):
+        self._version += 1
+        self.redirect_cache.clear()
+
+    def _get_catalog(self):
+        version = self._version
+        catalog = self._catalog
+        if catalog is None or catalog[0] != version:
+            by_id = {}
+            by_uuid = {}
+            by_article_url = {}
+            for vol in self:
+                by_id.setdefault(vol.volume_id, vol)
+                by_uuid.setdefault(vol.uuid, []).append(vol)
+                if vol.article_url:
+                    by_article_url.setdefault(vol.article_url, vol.uuid)
+            for vols in by_uuid.itervalues():
+                vols.sort(key=lambda d: d.volume)
+            catalog = (version, by_id, by_uuid, by_article_url)
+            self._catalog = catalog
+        return catalog
+
     def add(self, filename):
-        d = Volume(filename)
-        try:
-            index = self.index(d)
-        except ValueError:
+        return self.add_volume(Volume(filename))
+
+    def add_volume(self, d):
+        """
+        Append opened volume unless volume with the same id is already
+        in the library, in which case d is closed and existing volume
+        is returned.
+
+        """
+        existing = self.volume(d.volume_id)
+        if existing is None:
             self.append(d)
             return d
         else:
             d.close()
-            return self[index]
+            return existing
 
     def langs(self):
         return set((d.index_language for d in self))
 
     def uuids(self):
-        return set((d.uuid for d in self))
+        return set(self._get_catalog()[2])
 
     def volumes(self, uuid):
-        return sorted((d for d in self if d.uuid == uuid),
-                      key=lambda d: d.volume)
+        return list(self._get_catalog()[2].get(uuid, ()))
 
     def volume(self, volume_id):
-        r = [v for v in self if v.volume_id == volume_id]
-        return r[0] if r else None
+        return self._get_catalog()[1].get(volume_id)
 
     def dict_by_article_url(self, article_url):
         if article_url:
-            for vol in self:
-                if vol.article_url == article_url:
-                    return vol.uuid
+            return self._get_catalog()[3].get(article_url)
         return None
 
     def best_match(self, word, max_from_vol=50):
         return self._lookup(word, self,
                             self.best_match_comparisons, max_from_vol)
 
+    def best_match_page(self, word, page_size=50, cursor=None):
+        """
+        Return (entries, cursor) with up to page_size entries
+        best_match would produce for the word if it had no limit on
+        number of entries per volume. Pass returned cursor to get the
+        next page, cursor is None after the last page. Cursor is an
+        opaque string recording position in the index of the volume
+        being read and ranges of entries already returned from each
+        volume, so next page starts where previous one stopped.
+
+        """
+        if cursor:
+            state = _decode_cursor(cursor)
+            if state['w'] != word:
+                raise ValueError('Cursor is for a different word')
+        else:
+            state = dict(w=word, t=0, v=0, i=None, s=None, r={},
+                         ids=[vol.volume_id for vol in self])
+        lookup_word, section = split_word(word)
+        if not lookup_word:
+            return [], None
+        comparisons = self.best_match_comparisons
+        entries = []
+        while state['t'] < len(comparisons) and len(entries) < page_size:
+            ids = state['ids']
+            if state['v'] >= len(ids):
+                state['t'] += 1
+                state['v'] = 0
+                continue
+            vol = self.volume(ids[state['v']])
+            if vol is None:
+                state['v'] += 1
+                continue
+            cmp_func, strength = comparisons[state['t']]
+            #index ranges returned by previous tiers
+            ranges = state['r'].setdefault(vol.volume_id, [])
+            if state['i'] is None:
+                state['i'] = state['s'] = vol.position(lookup_word, strength)
+            index = state['i']
+            for entry in vol._lookup_from(index, lookup_word,
+                                          strength, cmp_func):
+                if len(entries) >= page_size:
+                    state['i'] = entry.index
+                    break
+                index = entry.index + 1
+                #same condition as seen set check in _lookup_tiers
+                if ((not section or entry.section) and
+                    _in_ranges(entry.index, ranges)):
+                    continue
+                if section and not entry.section:
+                    entry.section = section
+                entries.append(entry)
+            else:
+                ranges.append([state['s'], index])
+                state['i'] = state['s'] = None
+                state['v'] += 1
+        if state['t'] < len(comparisons):
+            return entries, _encode_cursor(state)
+        return entries, None
+
+    def fuzzy_lookup(self, word, max_distance=2, limit=10):
+        """
+        Return up to limit entries from all volumes with titles within
+        max_distance edits of word, closest first.
+
+        """
+        matches = []
+        for n, vol in enumerate(self):
+            for distance, entry in vol._fuzzy_matches(word, max_distance,
+                                                      limit):
+                matches.append((distance, n, entry.index, entry))
+        matches.sort()
+        return [entry for _, _, _, entry in matches[:limit]]
+
+    def search_text(self, query, limit=50):
+        """
+        Return up to limit entries from all volumes whose articles
+        contain all words and quoted phrases of query, best match
+        first.
+
+        """
+        matches = []
+        for n, vol in enumerate(self):
+            for score, entry in vol._search_text(query, limit):
+                matches.append((-score, n, entry.index, entry))
+        matches.sort()
+        return [entry for _, _, _, entry in matches[:limit]]
+
+    def glob(self, pattern, max_from_vol=50, cancelled=None):
+        """
+        Generate entries from all volumes whose titles match glob
+        pattern (see Volume.glob), volume by volume, taking no more
+        than max_from_vol entries from each.
+
+        """
+        for vol in self:
+            for n, entry in enumerate(vol.glob(pattern, cancelled)):
+                if n >= max_from_vol:
+                    break
+                yield entry
+
+    def search_substring(self, word):
+        """
+        Generate entries from all volumes whose titles contain word,
+        volume by volume.
+
+        """
+        for vol in self:
+            for entry in vol.search_substring(word):
+                yield entry
+
+    def count(self, word, strength=PRIMARY, cmp_func=cmp_word_start):
+        """
+        Total number of entries lookup() would yield for word in all
+        volumes.
+
+        """
+        word, _ = split_word(word)
+        return sum(vol.count(word, strength, cmp_func) for vol in self)
+
+    def lookup_many(self, words, max_from_vol=50):
+        """
+        Generate (word, entries) for each of words, with entries
+        being what best_match would produce for the word. Words are
+        processed in collation order, each volume's index is
+        traversed once from start to end.
+
+        """
+        comparisons = self.best_match_comparisons
+        volumes = list(self)
+        keyed_words = sort_by_key(words, PRIMARY,
+                                  lambda word: split_word(word)[0])
+        keys = [key for key, _ in keyed_words]
+        positions = [vol.primary_positions(keys) for vol in volumes]
+        for _, query in keyed_words:
+            starts = [p.next() for p in positions]
+            word, section = split_word(query)
+            if not word:
+                yield query, []
+                continue
+            tiers = [self._lookup_tiers(vol, word, section,
+                                        comparisons, max_from_vol, start)
+                     for vol, start in zip(volumes, starts)]
+            entries = []
+            for _ in comparisons:
+                for t in tiers:
+                    entries.extend(t.next())
+            yield query, entries
+
     def read(self, entry):
         vol = self.volume(entry.volume_id)
         if not vol:
@@ -701,32 +2511,81 @@ class Library(list):
         if not word:
             raise StopIteration
         word, section = split_word(word)
-        counts = defaultdict(int)
+        tiers = [self._lookup_tiers(vol, word, section,
+                                    comparisons, max_from_vol)
+                 for vol in volumes]
+        if self.executor and len(tiers) > 1:
+            streams = [_TierStream(t) for t in tiers]
+            for stream in streams:
+                self.executor.submit(stream.run)
+            try:
+                for i in range(len(comparisons)):
+                    for stream in streams:
+                        for entry in stream.get(i):
+                            yield entry
+            finally:
+                for stream in streams:
+                    stream.cancelled = True
+        else:
+            for _ in comparisons:
+                for t in tiers:
+                    for entry in t.next():
+                        yield entry
+
+    def _lookup_tiers(self, vol, word, section, comparisons, max_from_vol,
+                      start=None):
+        """
+        Generate list of entries from volume for each comparison,
+        taking no more than max_from_vol entries in total.
+
+        """
+        count = 0
         seen = set()
-        for cmp_func, strength in comparisons:
-            for vol in volumes:
-                count = counts[vol]
-                if count >= max_from_vol: continue
-                for entry in vol.lookup(word, strength, cmp_func):
+        for matches in vol.lookup_tiers(word, comparisons, start):
+            tier = []
+            if count < max_from_vol:
+                for entry in matches:
                     if entry not in seen:
                         if section and not entry.section:
                             entry.section = section
-                        yield entry
+                        tier.append(entry)
                         seen.add(entry)
                         count += 1
                         if count >= max_from_vol: break
-                counts[vol] = count
+            yield tier
 
     def _redirect(self, redirect):
         vol = self.volume(redirect.entry.volume_id)
         if vol:
-            try:
-                entry = self._find(redirect.target, vol.uuid).next()
+            entry = self._resolve(redirect, vol)
+            if entry:
                 entry.redirect_from = redirect.entry
                 return self.read(entry)
+
+    def _resolve(self, redirect, vol):
+        source = redirect.entry
+        key = (source.volume_id, source.index, source.section)
+        cache = self.redirect_cache
+        target = cache.get(key, _missing)
+        if target is _missing:
+            try:
+                entry = self._find(redirect.target, vol.uuid).next()
             except StopIteration:
-                pass
+                target = None
+            else:
+                target = (entry.volume_id, entry.index,
+                          entry.title, entry.section)
+            cache.put(key, target)
+        if target:
+            volume_id, index, title, section = target
+            return Entry(volume_id, index, title, section=section)
 
     def _find(self, word, dictionary_id):
         return self._lookup(word, self.volumes(dictionary_id),
                             self.find_comparisons[:len(word)], 1)
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'sort',
+              'reverse', '__setitem__', '__delitem__', '__setslice__',
+              '__delslice__', '__iadd__', '__imul__'):
+    setattr(Library, _name, _invalidating(_name))
+del _name
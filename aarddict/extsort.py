@@ -0,0 +1,91 @@
+# This file is part of Aard Dictionary <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2010 Igor Tkach
+
+"""
+External merge sort for record streams that may not fit in memory.
+
+"""
+
+import heapq
+import marshal
+import tempfile
+
+default_chunk_size = 500000
+
+
+def dump_records(records, f, block_size=1000):
+    """
+    Write sequence of records to file f in marshal blocks, to be read
+    back with load_records.
+
+    """
+    for i in xrange(0, len(records), block_size):
+        marshal.dump(records[i:i+block_size], f)
+
+
+def load_records(f):
+    """
+    Generate records written to f by dump_records, reading until end
+    of file.
+
+    """
+    while True:
+        try:
+            block = marshal.load(f)
+        except EOFError:
+            break
+        for record in block:
+            yield record
+
+
+def _write_run(records):
+    records.sort()
+    f = tempfile.TemporaryFile()
+    dump_records(records, f)
+    f.seek(0)
+    return f
+
+
+def _read_run(f):
+    try:
+        for record in load_records(f):
+            yield record
+    finally:
+        f.close()
+
+
+def external_sort(records, chunk_size=default_chunk_size):
+    """
+    Generate records in sorted order. Records must be tuples of
+    values marshal can serialize. Up to chunk_size records are sorted
+    in memory, larger inputs are sorted in chunks written to temporary
+    files and then merged.
+
+    >>> list(external_sort([(3, 'c'), (1, 'a'), (2, 'b'), (1, 'z')], 2))
+    [(1, 'a'), (1, 'z'), (2, 'b'), (3, 'c')]
+
+    """
+    runs = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            runs.append(_write_run(chunk))
+            chunk = []
+    if not runs:
+        chunk.sort()
+        return iter(chunk)
+    if chunk:
+        runs.append(_write_run(chunk))
+    return heapq.merge(*[_read_run(f) for f in runs])
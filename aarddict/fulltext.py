@@ -0,0 +1,454 @@
+# This file is part of Aard Dictionary <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2010 Igor Tkach
+
+"""
+Full-text search over article bodies backed by an inverted index.
+
+Articles are split into folded words (see dictionary.fold). Index
+file keeps sorted term table and, for each term, compressed posting
+list of word indexes with word positions, so AND and phrase queries
+only read postings of query terms. Matches are ranked with BM25.
+
+"""
+
+from __future__ import with_statement
+
+import heapq
+import marshal
+import math
+import mmap
+import os
+import re
+import tempfile
+import shutil
+import zlib
+
+from bisect import bisect_left
+from itertools import islice
+from struct import pack, unpack_from
+
+from aarddict.dictionary import (Entry, Redirect, Volume, SortKeyList,
+                                 atomic_write, cpu_count, fold,
+                                 read_index_header, spec_len, uint32_array,
+                                 uint32_string)
+from aarddict.extsort import dump_records, load_records
+
+max_runs = 256
+
+min_run_size = 1000
+
+max_term_length = 64
+
+postings_chunk_size = 1 << 16
+
+bm25_k1 = 1.2
+
+bm25_b = 0.75
+
+FULLTEXT_INDEX_SPEC = (('signature',     '>4s'), # string 'aart'
+                       ('version',       '>H'), # format version, current value 1
+                       ('index_count',   '>L'), # must match volume's index count
+                       ('doc_count',     '>L'), # number of indexed articles
+                       ('term_count',    '>L'), # number of distinct terms
+                       ('total_length',  '>Q'), # number of words in all articles
+                       ('lengths',       '>Q'), # offset of article lengths table
+                       ('term_offsets',  '>Q'), # offset of term offsets table
+                       ('term_data',     '>Q'), # offset of term data
+                       ('records',       '>Q'), # offset of term records table
+                       ('postings',      '>Q'), # offset of posting lists
+                       )
+
+_markup_re = re.compile(r'<[^>]*>|&#?\w+;')
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+_query_re = re.compile(r'"([^"]*)"?|(\S+)', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    List of folded words in text, with markup removed.
+
+    >>> tokenize(u'<p>Caf\\xe9 &amp; <b>Bar</b></p>')
+    [u'cafe', u'bar']
+
+    """
+    return [word for word in
+            (fold(w) for w in _word_re.findall(_markup_re.sub(u' ', text)))
+            if len(word) <= max_term_length]
+
+
+def parse_query(query):
+    """
+    Split query into phrases, each a list of folded words. Quoted
+    text is a phrase, any other word is a phrase by itself.
+
+    >>> parse_query(u'"wave equation" Maxwell')
+    [[u'wave', u'equation'], [u'maxwell']]
+    >>> parse_query(u'"" <>')
+    []
+
+    """
+    phrases = []
+    for quoted, word in _query_re.findall(query):
+        phrase = tokenize(quoted or word)
+        if phrase:
+            phrases.append(phrase)
+    return phrases
+
+
+_volumes = {}
+
+def _index_run(args):
+    """
+    Index articles start to end of a volume and write their postings
+    to run_name: list of article lengths followed by sorted (term,
+    postings) records, where postings is flat list of index, word
+    count and word positions for each article containing the term.
+
+    """
+    volume_file_name, run_name, start, end = args
+    volume = _volumes.get(volume_file_name)
+    if volume is None:
+        volume = _volumes[volume_file_name] = Volume(volume_file_name)
+    lengths = []
+    postings = {}
+    for i in xrange(start, end):
+        article = volume.read(Entry(volume.volume_id, i))
+        if isinstance(article, Redirect):
+            lengths.append(0)
+            continue
+        words = tokenize(volume.words[i]) + tokenize(article.text)
+        lengths.append(len(words))
+        positions = {}
+        for pos, word in enumerate(words):
+            positions.setdefault(word, []).append(pos)
+        for word, word_positions in positions.iteritems():
+            term_postings = postings.setdefault(word.encode('utf8'), [])
+            term_postings.append(i)
+            term_postings.append(len(word_positions))
+            term_postings.extend(word_positions)
+    with atomic_write(run_name) as f:
+        marshal.dump(lengths, f)
+        dump_records(sorted(postings.iteritems()), f, block_size=100)
+    return run_name
+
+
+def _read_run(f, n):
+    for term, postings in load_records(f):
+        yield term, n, postings
+
+
+def _delta_encode(postings, last_index):
+    """
+    Convert flat postings list to array with indexes and positions
+    stored as differences to previous ones.
+
+    >>> encoded, last_index, docs = _delta_encode([3, 2, 1, 4, 5, 1, 0], 1)
+    >>> encoded.tolist(), last_index, docs
+    ([2L, 2L, 1L, 3L, 2L, 1L, 0L], 5, 2)
+
+    """
+    result = uint32_array()
+    docs = 0
+    i = 0
+    while i < len(postings):
+        index, count = postings[i], postings[i+1]
+        result.append(index - last_index)
+        result.append(count)
+        last_pos = 0
+        for pos in postings[i+2:i+2+count]:
+            result.append(pos - last_pos)
+            last_pos = pos
+        last_index = index
+        docs += 1
+        i += 2 + count
+    return result, last_index, docs
+
+
+class FullTextIndex(object):
+    """
+    Inverted index of volume articles, stored as index file keyed by
+    volume's sha1sum. File consists of header, table of article
+    lengths, sorted term table (offsets followed by data, same layout
+    as sort key index), table of (offset, length, article count) term
+    records and posting lists - compressed big-endian arrays of index
+    delta, word count and position deltas.
+
+    """
+
+    ext = '.text'
+    signature = 'aart'
+    version = 1
+    description = 'full-text index'
+
+    def __init__(self, file_name, index_count):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            header = read_index_header(f, FULLTEXT_INDEX_SPEC, self,
+                                       index_count)
+            self.fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.doc_count = header['doc_count']
+        self.avg_length = float(header['total_length'])/max(1, self.doc_count)
+        self.lengths_pos = header['lengths']
+        self.records_pos = header['records']
+        self.postings_pos = header['postings']
+        self.terms = SortKeyList(self.fmap, header['term_offsets'],
+                                 header['term_data'], header['term_count'])
+
+    @classmethod
+    def build(cls, file_name, words, volume_file_name, processes=None):
+        """
+        Index all articles of volume and write index to file_name,
+        yielding progress. Articles are indexed in runs by a pool of
+        processes, each run is kept until index is complete, so
+        interrupted build resumes from runs already written.
+
+        """
+        count = len(words)
+        run_size = max(min_run_size, -(-count // max_runs))
+        runs = []
+        for n, start in enumerate(xrange(0, count, run_size)):
+            runs.append((volume_file_name, '%s.%03d.run' % (file_name, n),
+                         start, min(count, start + run_size)))
+        pending = [run for run in runs if not os.path.exists(run[1])]
+        done = len(runs) - len(pending)
+        if processes is None:
+            processes = cpu_count()
+        if processes > 1 and len(pending) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                for _ in pool.imap_unordered(_index_run, pending):
+                    done += 1
+                    yield 0.9*done/len(runs)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for run in pending:
+                _index_run(run)
+                done += 1
+                yield 0.9*done/len(runs)
+        for progress in cls._merge(file_name, count, [run[1] for run in runs]):
+            yield 0.9 + 0.1*progress
+        for run in runs:
+            os.remove(run[1])
+        yield 1.0
+
+    @classmethod
+    def _merge(cls, file_name, count, run_names):
+        run_files = [open(name, 'rb') for name in run_names]
+        term_offsets = tempfile.TemporaryFile()
+        term_data = tempfile.TemporaryFile()
+        records = tempfile.TemporaryFile()
+        postings = tempfile.TemporaryFile()
+        try:
+            lengths = uint32_array()
+            for f in run_files:
+                lengths.extend(marshal.load(f))
+            total_size = sum(os.path.getsize(name) for name in run_names)
+            streams = [_read_run(f, n) for n, f in enumerate(run_files)]
+            term_offsets.write(pack('>L', 0))
+            term_count = 0
+            term_pos = 0
+            postings_pos = 0
+            current = None
+            for term, _, run_postings in heapq.merge(*streams):
+                if term != current:
+                    if current is not None:
+                        data = compressor.flush()
+                        postings.write(data)
+                        length += len(data)
+                        records.write(pack('>QLL', postings_pos,
+                                           length, doc_count))
+                        postings_pos += length
+                    current = term
+                    compressor = zlib.compressobj()
+                    last_index = 0
+                    length = 0
+                    doc_count = 0
+                    term_data.write(term)
+                    term_pos += len(term)
+                    term_offsets.write(pack('>L', term_pos))
+                    term_count += 1
+                    if term_count % 10000 == 0:
+                        yield float(sum(f.tell() for f in run_files))/total_size
+                encoded, last_index, docs = _delta_encode(run_postings,
+                                                          last_index)
+                doc_count += docs
+                data = compressor.compress(uint32_string(encoded))
+                postings.write(data)
+                length += len(data)
+            if current is not None:
+                data = compressor.flush()
+                postings.write(data)
+                length += len(data)
+                records.write(pack('>QLL', postings_pos, length, doc_count))
+            pos = spec_len(FULLTEXT_INDEX_SPEC)
+            sections = []
+            for size in (4*count, 4*(term_count + 1), term_pos,
+                         16*term_count, 0):
+                sections.append(pos)
+                pos += size
+            with atomic_write(file_name) as out:
+                out.write(pack('>4sHLLLQ', cls.signature, cls.version, count,
+                               sum(1 for n in lengths if n),
+                               term_count, sum(lengths)))
+                for pos in sections:
+                    out.write(pack('>Q', pos))
+                out.write(uint32_string(lengths))
+                for f in (term_offsets, term_data, records, postings):
+                    f.seek(0)
+                    shutil.copyfileobj(f, out)
+        finally:
+            for f in run_files + [term_offsets, term_data, records, postings]:
+                f.close()
+
+    def find(self, term):
+        """
+        Return (offset, length, article count) record of term or None
+        if term is not in the index.
+
+        """
+        key = term.encode('utf8')
+        i = bisect_left(self.terms, key)
+        if i < len(self.terms) and self.terms[i] == key:
+            return unpack_from('>QLL', self.fmap, self.records_pos + 16*i)
+        return None
+
+    def values(self, record):
+        """
+        Generate integers of record's posting list, decompressing it
+        piece by piece from mapped file, so memory use does not
+        depend on its length.
+
+        """
+        offset, length, _ = record
+        start = self.postings_pos + offset
+        end = start + length
+        decompressor = zlib.decompressobj()
+        rest = ''
+        pos = start
+        while pos < end:
+            chunk_end = min(pos + postings_chunk_size, end)
+            data = rest + decompressor.decompress(self.fmap[pos:chunk_end])
+            pos = chunk_end
+            if pos >= end:
+                data += decompressor.flush()
+            n = len(data) - len(data) % 4
+            rest = data[n:]
+            for value in uint32_array(data[:n]):
+                yield value
+
+    def entries(self, record, wanted=None, positions=False):
+        """
+        Generate (word index, word count, positions) for articles in
+        record's posting list that are in wanted set (all if wanted is
+        None). Positions are decoded only if asked for, otherwise they
+        are skipped and None is generated instead. Scanning stops
+        after the largest wanted index.
+
+        """
+        if wanted is not None and not wanted:
+            return
+        last = max(wanted) if wanted else None
+        values = self.values(record)
+        index = 0
+        for delta in values:
+            index += delta
+            if last is not None and index > last:
+                return
+            count = values.next()
+            if wanted is None or index in wanted:
+                if positions:
+                    word_positions = []
+                    pos = 0
+                    for step in islice(values, count):
+                        pos += step
+                        word_positions.append(pos)
+                    yield index, count, word_positions
+                    continue
+                yield index, count, None
+            for _ in islice(values, count):
+                pass
+
+    def length(self, index):
+        return unpack_from('>L', self.fmap, self.lengths_pos + 4*index)[0]
+
+    def search(self, query, limit):
+        """
+        Return up to limit (score, index) tuples for articles
+        containing all query phrases, best first.
+
+        """
+        phrases = parse_query(query)
+        if not phrases:
+            return []
+        terms = set(term for phrase in phrases for term in phrase)
+        records = {}
+        for term in terms:
+            record = self.find(term)
+            if record is None:
+                return []
+            records[term] = record
+        #intersect article indexes, starting with rarest term so that
+        #candidate set is smallest and later lists are only scanned
+        counts = {}
+        candidates = None
+        for term in sorted(terms, key=lambda t: records[t][2]):
+            counts[term] = term_counts = {}
+            for index, count, _ in self.entries(records[term], candidates):
+                term_counts[index] = count
+            candidates = set(term_counts)
+            if not candidates:
+                return []
+        #positions are decoded only for articles left
+        positions = {}
+        for phrase in phrases:
+            if len(phrase) > 1:
+                for term in phrase:
+                    if term not in positions:
+                        positions[term] = dict(
+                            (index, word_positions) for index, _, word_positions
+                            in self.entries(records[term], candidates, True))
+                candidates = set(i for i in candidates
+                                 if self._has_phrase(i, phrase, positions))
+        scored = []
+        for i in candidates:
+            scored.append((self._score(i, terms, records, counts), -i))
+        return [(score, -i) for score, i in heapq.nlargest(limit, scored)]
+
+    def _has_phrase(self, index, phrase, positions):
+        following = [set(positions[term][index]) for term in phrase[1:]]
+        for pos in positions[phrase[0]][index]:
+            for n, term_positions in enumerate(following):
+                if pos + n + 1 not in term_positions:
+                    break
+            else:
+                return True
+        return False
+
+    def _score(self, index, terms, records, counts):
+        norm = bm25_k1*(1 - bm25_b + bm25_b*self.length(index)/self.avg_length)
+        score = 0.0
+        for term in terms:
+            docs = records[term][2]
+            idf = math.log(1 + (self.doc_count - docs + 0.5)/(docs + 0.5))
+            tf = counts[term][index]
+            score += idf*tf*(bm25_k1 + 1)/(tf + norm)
+        return score
+
+    def close(self):
+        self.fmap.close()
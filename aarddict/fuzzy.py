@@ -0,0 +1,307 @@
+# This file is part of Aard Dictionary <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2010 Igor Tkach
+
+"""
+Typo tolerant title lookup backed by trigram posting lists.
+
+Titles are folded (see dictionary.fold), padded and split into
+trigrams. Index file has a sorted table of trigrams, each with a
+compressed sorted list of word indexes containing it, and folded
+length of each title. A title within edit distance k of the query
+shares at least len(query trigrams) - 3*k trigrams with it and differs
+from it in length by at most k, so only titles passing both checks are
+compared with the query. Short queries allow fewer edits (see
+allowed_distance), otherwise the trigram check would pass nearly every
+title.
+
+"""
+
+from __future__ import with_statement
+
+import mmap
+import shutil
+import tempfile
+import zlib
+
+from bisect import bisect_left
+from struct import calcsize, pack, unpack_from
+
+from aarddict.dictionary import (SortKeyList, atomic_write, fold,
+                                 read_index_header, split_word, spec_len,
+                                 uint32_array, uint32_string)
+from aarddict.extsort import external_sort
+
+Q = 3
+
+PAD = u'\x00'*(Q - 1)
+
+FUZZY_INDEX_SPEC = (('signature',     '>4s'), # string 'aarf'
+                    ('version',       '>H'), # format version, current value 2
+                    ('index_count',   '>L'), # must match volume's index count
+                    ('gram_count',    '>L'), # number of distinct trigrams
+                    ('gram_offsets',  '>Q'), # offset of trigram offsets table
+                    ('gram_data',     '>Q'), # offset of UTF-8 trigrams
+                    ('gram_postings', '>Q'), # offset of posting list table
+                    ('lengths',       '>Q'), # offset of folded title lengths
+                    ('postings',      '>Q'), # offset of posting lists
+                    )
+
+#posting list offset relative to posting lists section, compressed
+#length and number of word indexes in it
+POSTING_SPEC = '>QLL'
+
+posting_len = calcsize(POSTING_SPEC)
+
+LENGTH_SPEC = '>H'
+
+max_length = 0xffff
+
+
+def allowed_distance(length):
+    """
+    Largest edit distance worth looking for in titles similar to a
+    folded query of given length.
+
+    >>> [allowed_distance(n) for n in (1, 2, 3, 5, 6, 10)]
+    [0, 0, 1, 1, 2, 2]
+
+    """
+    if length <= 2:
+        return 0
+    if length <= 5:
+        return 1
+    return 2
+
+
+def grams(folded):
+    """
+    Set of trigrams of padded folded title.
+
+    >>> sorted(grams(u'abc'))
+    [u'\\x00\\x00a', u'\\x00ab', u'abc', u'bc\\x00', u'c\\x00\\x00']
+
+    """
+    s = PAD + folded + PAD
+    return set(s[i:i+Q] for i in xrange(len(s) - Q + 1))
+
+
+def edit_distance(s1, s2, limit):
+    """
+    Levenshtein distance between s1 and s2, or limit + 1 if it
+    exceeds limit.
+
+    >>> edit_distance(u'kitten', u'sitting', 5)
+    3
+    >>> edit_distance(u'kitten', u'sitting', 2)
+    3
+    >>> edit_distance(u'abc', u'abc', 0)
+    0
+
+    """
+    if abs(len(s1) - len(s2)) > limit:
+        return limit + 1
+    previous = range(len(s2) + 1)
+    for i, c1 in enumerate(s1):
+        current = [i + 1]
+        for j, c2 in enumerate(s2):
+            current.append(min(previous[j + 1] + 1,
+                               current[j] + 1,
+                               previous[j] + (c1 != c2)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+class FuzzyIndex(object):
+    """
+    Trigram index of volume titles, stored as index file keyed by
+    volume's sha1sum. File consists of header, sorted UTF-8 trigrams
+    (offsets followed by data, same layout as sort key index), table of
+    their posting list locations, folded title lengths and posting
+    lists - compressed big-endian arrays of word indexes.
+
+    """
+
+    ext = '.fuzzy'
+    signature = 'aarf'
+    version = 2
+    description = 'fuzzy index'
+
+    def __init__(self, file_name, index_count):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            header = read_index_header(f, FUZZY_INDEX_SPEC, self, index_count)
+            self.fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.grams = SortKeyList(self.fmap, header['gram_offsets'],
+                                 header['gram_data'], header['gram_count'])
+        self.gram_postings = header['gram_postings']
+        self.lengths = header['lengths']
+        self.postings_offset = header['postings']
+
+    @classmethod
+    def build(cls, file_name, words):
+        """
+        Write trigram index for words to file_name, yielding
+        progress. (trigram, index) pairs are sorted externally, so only
+        one posting list at a time is held in memory.
+
+        """
+        count = len(words)
+        total = [0]
+        files = [tempfile.TemporaryFile() for _ in range(5)]
+        gram_offsets, gram_data, gram_postings, lengths, postings = files
+
+        def pairs():
+            for i, word in enumerate(words):
+                word, _ = split_word(word)
+                folded = fold(word)
+                lengths.write(pack(LENGTH_SPEC, min(len(folded), max_length)))
+                for gram in grams(folded):
+                    total[0] += 1
+                    yield gram.encode('utf8'), i
+
+        try:
+            gram_count = 0
+            gram_offsets.write(pack('>L', 0))
+            current = None
+            indexes = uint32_array()
+            for n, (gram, i) in enumerate(external_sort(pairs())):
+                if gram != current:
+                    if current is not None:
+                        cls._write_postings(files, current, indexes)
+                        gram_count += 1
+                    current = gram
+                    indexes = uint32_array()
+                indexes.append(i)
+                if n % 100000 == 0:
+                    yield float(n)/max(1, total[0])
+            if current is not None:
+                cls._write_postings(files, current, indexes)
+                gram_count += 1
+            pos = spec_len(FUZZY_INDEX_SPEC)
+            sections = []
+            for f in files:
+                sections.append(pos)
+                pos += f.tell()
+            with atomic_write(file_name) as out:
+                out.write(pack('>4sHLL', cls.signature, cls.version,
+                               count, gram_count))
+                for pos in sections:
+                    out.write(pack('>Q', pos))
+                for f in files:
+                    f.seek(0)
+                    shutil.copyfileobj(f, out)
+        finally:
+            for f in files:
+                f.close()
+        yield 1.0
+
+    @staticmethod
+    def _write_postings(files, gram, indexes):
+        gram_offsets, gram_data, gram_postings, lengths, postings = files
+        gram_data.write(gram)
+        gram_offsets.write(pack('>L', gram_data.tell()))
+        data = zlib.compress(uint32_string(indexes))
+        gram_postings.write(pack(POSTING_SPEC, postings.tell(),
+                                 len(data), len(indexes)))
+        postings.write(data)
+
+    def find(self, gram):
+        """
+        Return (offset, length, count) of posting list of gram, or
+        None if no title has it.
+
+        """
+        key = gram.encode('utf8')
+        i = bisect_left(self.grams, key)
+        if i < len(self.grams) and self.grams[i] == key:
+            return unpack_from(POSTING_SPEC, self.fmap,
+                               self.gram_postings + posting_len*i)
+        return None
+
+    def postings(self, location):
+        offset, length, _ = location
+        start = self.postings_offset + offset
+        return uint32_array(zlib.decompress(buffer(self.fmap, start, length)))
+
+    def length(self, i):
+        """
+        Length of i-th folded title.
+
+        """
+        return unpack_from(LENGTH_SPEC, self.fmap, self.lengths + 2*i)[0]
+
+    def candidates(self, word, max_distance):
+        """
+        Indexes of words sharing enough trigrams with word and close
+        enough to it in length to be within max_distance edits of it
+        (and at least one trigram).
+
+        """
+        folded = fold(word)
+        all_grams = grams(folded)
+        threshold = max(1, len(all_grams) - Q*max_distance)
+        locations = filter(None, [self.find(g) for g in all_grams])
+        if len(locations) < threshold:
+            return []
+        locations.sort(key=lambda location: location[2])
+        #any title with threshold matches must be in one of these
+        short = len(locations) - threshold + 1
+        counts = {}
+        for location in locations[:short]:
+            for i in self.postings(location):
+                counts[i] = counts.get(i, 0) + 1
+        long_lists = []
+        for location in locations[short:]:
+            long_lists.append(self.postings(location))
+        min_len = len(folded) - max_distance
+        max_len = len(folded) + max_distance
+        result = []
+        for i, count in counts.iteritems():
+            if not min_len <= self.length(i) <= max_len:
+                continue
+            remaining = len(long_lists)
+            for postings in long_lists:
+                if count >= threshold or count + remaining < threshold:
+                    break
+                remaining -= 1
+                pos = bisect_left(postings, i)
+                if pos < len(postings) and postings[pos] == i:
+                    count += 1
+            if count >= threshold:
+                result.append(i)
+        result.sort()
+        return result
+
+    def lookup(self, words, word, max_distance, limit):
+        """
+        Return up to limit (distance, index) tuples for words
+        within max_distance edits of word, closest first. Fewer edits
+        are allowed for short words, see allowed_distance.
+
+        """
+        folded = fold(word)
+        max_distance = min(max_distance, allowed_distance(len(folded)))
+        result = []
+        for i in self.candidates(word, max_distance):
+            title, _ = split_word(words[i])
+            distance = edit_distance(fold(title), folded, max_distance)
+            if distance <= max_distance:
+                result.append((distance, i))
+        result.sort()
+        return result[:limit]
+
+    def close(self):
+        self.fmap.close()
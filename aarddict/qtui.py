@@ -54,9 +54,11 @@ from aarddict.dictionary import (format_title,
                                  SECONDARY,
                                  TERTIARY,
                                  Entry,
+                                 is_glob,
                                  Article,
                                  cmp_words,
-                                 VerifyError)
+                                 VerifyError,
+                                 WorkerPool)
 
 from aarddict import state, res
 from aarddict.res import icons
@@ -182,7 +184,12 @@ class WordLookupThread(QThread):
         t0 = time.time()
         entries = []
         try:
-            for entry in self.dictionaries.best_match(wordstr):
+            if is_glob(wordstr):
+                matches = self.dictionaries.glob(
+                    wordstr, cancelled=lambda: self.stop_requested)
+            else:
+                matches = self.dictionaries.best_match(wordstr)
+            for entry in matches:
                 if self.stop_requested:
                     raise WordLookupStopRequested
                 else:
@@ -254,6 +261,9 @@ class DictOpenThread(QThread):
     dict_open_succeded = pyqtSignal(Volume)
     dict_open_started = pyqtSignal(int)
 
+    #opening is mostly waiting on disk, so use more threads than cores
+    max_workers = 8
+
     def __init__(self, sources, dictionaries, parent=None):
         QThread.__init__(self, parent)
         self.sources = sources
@@ -273,15 +283,33 @@ class DictOpenThread(QThread):
                     if os.path.isfile(s) and f.lower().endswith(ext):
                         files.append(s)
         self.dict_open_started.emit(len(files))
-        for candidate in files:
-            if self.stop_requested:
-                return
-            try:
-                vol = self.dictionaries.add(candidate)
-            except Exception, e:
-                self.dict_open_failed.emit(candidate, str(e))
-            else:
-                self.dict_open_succeded.emit(vol)
+        if not files:
+            return
+        pool = WorkerPool(min(self.max_workers, len(files)))
+        tasks = [(candidate, pool.submit(Volume, candidate))
+                 for candidate in files]
+        try:
+            #volumes open concurrently, but are added in source order
+            for candidate, task in tasks:
+                if self.stop_requested:
+                    return
+                try:
+                    vol = self.dictionaries.add_volume(task.wait())
+                except Exception, e:
+                    self.dict_open_failed.emit(candidate, str(e))
+                else:
+                    self.dict_open_succeded.emit(vol)
+        finally:
+            for _, task in tasks:
+                task.cancel()
+            for candidate, task in tasks:
+                try:
+                    vol = task.wait()
+                except Exception:
+                    continue
+                if vol is not None and vol not in self.dictionaries:
+                    vol.close()
+            pool.shutdown()
 
     def stop(self):
         self.stop_requested = True
@@ -563,6 +591,7 @@ class DictView(QMainWindow):
         self.setWindowIcon(icons['aarddict'])
 
         self.dictionaries = Library()
+        self.dictionaries.executor = WorkerPool()
         self.update_title()
 
         self.word_completion = QListWidget()
@@ -986,6 +1015,8 @@ class DictView(QMainWindow):
         mn_debug = self.menuBar().addMenu('Debug')
         mn_debug.addAction(QAction('Cache Stats', self,
                                    triggered=debug.dump_cache_stats))
+        mn_debug.addAction(QAction('Codec Stats', self,
+                                   triggered=debug.dump_codec_stats))
         mn_debug.addAction(QAction('Instances Diff', self,
                                    triggered=debug.dump_type_count_diff))
         mn_debug.addAction(QAction('Set Instances Diff Checkpoint', self,
@@ -1586,8 +1617,16 @@ class DictView(QMainWindow):
             item = QTableWidgetItem(text)
             item.setData(Qt.UserRole, QVariant(volume.volume_id))
             item_list.setItem(i, 1, item)
-            item = QTableWidgetItem(_('Unverified'))
-            item.setData(Qt.DecorationRole, icons['question'])
+            verified = volume.verified()
+            if verified is None:
+                item = QTableWidgetItem(_('Unverified'))
+                item.setData(Qt.DecorationRole, icons['question'])
+            elif verified:
+                item = QTableWidgetItem(_('Ok'))
+                item.setData(Qt.DecorationRole, icons['emblem-ok'])
+            else:
+                item = QTableWidgetItem(_('Corrupt'))
+                item.setData(Qt.DecorationRole, icons['emblem-unreadable'])
             item_list.setItem(i, 0, item)
 
         item_list.horizontalHeader().setStretchLastSection(True)
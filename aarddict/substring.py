@@ -0,0 +1,205 @@
+# This file is part of Aard Dictionary <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2010 Igor Tkach
+
+"""
+Infix and suffix title search backed by a suffix array.
+
+Titles are folded (see dictionary.fold) and UTF-8 encoded. Index file
+keeps folded titles and all their suffixes starting at character
+boundaries, sorted, so titles containing a substring correspond to a
+contiguous range of suffixes found by two binary searches.
+
+"""
+
+from __future__ import with_statement
+
+import mmap
+import shutil
+import tempfile
+
+from bisect import bisect_left
+from struct import pack, unpack_from
+
+from aarddict.dictionary import (SortKeyList, atomic_write, fold,
+                                 read_index_header, split_word, spec_len)
+from aarddict.extsort import external_sort
+
+max_title_length = 0xffff
+
+SUBSTRING_INDEX_SPEC = (('signature',     '>4s'), # string 'aars'
+                        ('version',       '>H'), # format version, current value 1
+                        ('index_count',   '>L'), # must match volume's index count
+                        ('suffix_count',  '>L'), # number of suffixes
+                        ('title_offsets', '>Q'), # offset of title offsets table
+                        ('title_data',    '>Q'), # offset of folded titles
+                        ('suffixes',      '>Q'), # offset of suffix table
+                        )
+
+SUFFIX_SPEC = '>LH'
+
+suffix_len = 6
+
+
+def folded_title(word):
+    """
+    Folded UTF-8 encoded title part of word.
+
+    >>> folded_title(u'Wave Equation#Solutions')
+    'wave equation'
+
+    """
+    title, _ = split_word(word)
+    return fold(title).encode('utf8')[:max_title_length]
+
+
+def suffixes(title):
+    """
+    Positions of suffixes of UTF-8 encoded title that start at
+    character boundaries.
+
+    >>> list(suffixes(u'a\\xe9b'.encode('utf8')))
+    [0, 1, 3]
+
+    """
+    for pos, c in enumerate(title):
+        if ord(c) & 0xc0 != 0x80:
+            yield pos
+
+
+class SuffixList(object):
+    """
+    Sorted suffixes of folded titles, read from substring index file.
+
+    """
+
+    def __init__(self, fmap, pos, length, titles):
+        self.fmap = fmap
+        self.pos = pos
+        self.length = length
+        self.titles = titles
+
+    def __len__(self):
+        return self.length
+
+    def item(self, i):
+        """
+        Return (word index, byte offset in folded title) of i-th suffix.
+
+        """
+        if 0 <= i < self.length:
+            return unpack_from(SUFFIX_SPEC, self.fmap, self.pos + suffix_len*i)
+        else:
+            raise IndexError
+
+    def __getitem__(self, i):
+        index, offset = self.item(i)
+        return self.titles[index][offset:]
+
+
+class SubstringIndex(object):
+    """
+    Suffix array of volume titles, stored as index file keyed by
+    volume's sha1sum. File consists of header, folded titles (offsets
+    followed by data, same layout as sort key index) and table of
+    sorted suffixes, each a word index and byte offset in its title.
+
+    """
+
+    ext = '.suffixes'
+    signature = 'aars'
+    version = 1
+    description = 'substring index'
+
+    def __init__(self, file_name, index_count):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            header = read_index_header(f, SUBSTRING_INDEX_SPEC, self,
+                                       index_count)
+            self.fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.titles = SortKeyList(self.fmap, header['title_offsets'],
+                                  header['title_data'], index_count)
+        self.suffixes = SuffixList(self.fmap, header['suffixes'],
+                                   header['suffix_count'], self.titles)
+
+    @classmethod
+    def build(cls, file_name, words):
+        """
+        Write suffix array of folded titles to file_name, yielding
+        progress. Suffixes are sorted externally, so memory use does not
+        depend on number of titles.
+
+        """
+        count = len(words)
+        total = [0]
+        title_offsets = tempfile.TemporaryFile()
+        title_data = tempfile.TemporaryFile()
+        suffix_table = tempfile.TemporaryFile()
+
+        def records():
+            pos = 0
+            title_offsets.write(pack('>L', pos))
+            for i, word in enumerate(words):
+                title = folded_title(word)
+                title_data.write(title)
+                pos += len(title)
+                title_offsets.write(pack('>L', pos))
+                for offset in suffixes(title):
+                    total[0] += 1
+                    yield title[offset:], i, offset
+
+        try:
+            for n, (_, i, offset) in enumerate(external_sort(records())):
+                suffix_table.write(pack(SUFFIX_SPEC, i, offset))
+                if n % 100000 == 0:
+                    yield float(n)/total[0]
+            pos = spec_len(SUBSTRING_INDEX_SPEC)
+            sections = []
+            for f in (title_offsets, title_data, suffix_table):
+                sections.append(pos)
+                pos += f.tell()
+            with atomic_write(file_name) as out:
+                out.write(pack('>4sHLL', cls.signature, cls.version,
+                               count, total[0]))
+                for pos in sections:
+                    out.write(pack('>Q', pos))
+                for f in (title_offsets, title_data, suffix_table):
+                    f.seek(0)
+                    shutil.copyfileobj(f, out)
+        finally:
+            for f in (title_offsets, title_data, suffix_table):
+                f.close()
+        yield 1.0
+
+    def search(self, word):
+        """
+        Generate indexes of words whose folded titles contain folded
+        word, each once, in order of matching suffixes.
+
+        """
+        key = fold(word).encode('utf8')
+        if not key:
+            return
+        lo = bisect_left(self.suffixes, key)
+        #'\xff' never occurs in UTF-8, so it sorts after any suffix
+        #starting with key
+        hi = bisect_left(self.suffixes, key + '\xff', lo)
+        seen = set()
+        for i in xrange(lo, hi):
+            index, _ = self.suffixes.item(i)
+            if index not in seen:
+                seen.add(index)
+                yield index
+
+    def close(self):
+        self.fmap.close()
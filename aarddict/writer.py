@@ -0,0 +1,402 @@
+# This file is part of Aard Dictionary <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2010 Igor Tkach
+
+"""
+Writer for dictionary files.
+
+Articles are given as a stream of (title, text, meta) tuples. They are
+serialized and compressed by a pool of processes and appended to a
+temporary file in input order, while (collation key, title, article
+location) records are sorted externally. Sorted records are then
+distributed over one or more volumes no larger than maximum volume
+size, and each volume is assembled with header, metadata, index1,
+index2 and articles laid out as described by dictionary.HEADER_SPEC.
+
+"""
+
+from __future__ import with_statement
+
+import bz2
+import os
+import shutil
+import tempfile
+import zlib
+
+from hashlib import sha1
+from struct import pack, calcsize
+from uuid import uuid4
+
+import simplejson
+
+from aarddict.dictionary import (HEADER_SPEC, TERTIARY, Volume,
+                                 collation_key, cpu_count, lzma,
+                                 replace_file, spec_len)
+from aarddict.extsort import dump_records, load_records, external_sort
+
+default_max_volume_size = (2 << 30) - 1
+
+index1_item_format = '>LL'
+
+#version 2 index1 item: key pointer, block pointer, offset in block
+block_index1_item_format = '>LLL'
+
+default_block_size = 64 << 10
+
+key_length_format = '>H'
+
+article_length_format = '>L'
+
+compressors = {'zlib': zlib.compress,
+               'bz2': bz2.compress}
+
+if lzma:
+    compressors['xz'] = lzma.compress
+
+sort_block_size = 10000
+
+
+def _prepare(args):
+    """
+    Return collation key, UTF-8 encoded title and serialized
+    article for (title, text, meta, compression) tuple, compressed
+    unless compression is None.
+
+    """
+    title, text, meta, compression = args
+    key = collation_key(title, TERTIARY).getByteArray()
+    data = simplejson.dumps([text, [], meta])
+    if compression:
+        data = compressors[compression](data)
+    return key, title.encode('utf8'), data
+
+
+class _VolumeData(object):
+    """
+    Index and article sections of one volume being written, kept in
+    temporary files until number of volumes is known. If compress is
+    given, articles are added uncompressed and packed into blocks of
+    about block_size bytes, each compressed as a whole (format
+    version 2).
+
+    """
+
+    def __init__(self, tmp_dir, n, fixed_size, compress=None,
+                 block_size=default_block_size):
+        self.files = [open(os.path.join(tmp_dir, '%d.%s' % (n, name)), 'w+b')
+                      for name in ('index1', 'index2', 'articles')]
+        self.index1, self.index2, self.articles = self.files
+        self.count = 0
+        self.key_pos = 0
+        self.article_pos = 0
+        self.size = fixed_size
+        self.compress = compress
+        self.block_size = block_size
+        self.block = []
+        self.block_len = 0
+
+    def _get_version(self):
+        return 1 if self.compress is None else 2
+
+    version = property(_get_version)
+
+    def _get_item_format(self):
+        if self.version == 1:
+            return index1_item_format
+        return block_index1_item_format
+
+    item_format = property(_get_item_format)
+
+    def add(self, title, article):
+        if self.version == 1:
+            self.index1.write(pack(index1_item_format,
+                                   self.key_pos, self.article_pos))
+            self._write_unit(article)
+        else:
+            self.index1.write(pack(block_index1_item_format, self.key_pos,
+                                   self.article_pos, self.block_len))
+            self.block.append(pack(article_length_format, len(article)))
+            self.block.append(article)
+            self.block_len += calcsize(article_length_format) + len(article)
+            if self.block_len >= self.block_size:
+                self.flush()
+        self.index2.write(pack(key_length_format, len(title)))
+        self.index2.write(title)
+        self.key_pos += calcsize(key_length_format) + len(title)
+        self.size += entry_size(title, article, self.item_format)
+        self.count += 1
+
+    def _write_unit(self, data):
+        self.articles.write(pack(article_length_format, len(data)))
+        self.articles.write(data)
+        self.article_pos += calcsize(article_length_format) + len(data)
+
+    def flush(self):
+        """
+        Compress and write pending block, if any.
+
+        """
+        if self.block:
+            self._write_unit(self.compress(''.join(self.block)))
+            self.block = []
+            self.block_len = 0
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def entry_size(title, article, item_format=index1_item_format):
+    return (calcsize(item_format) + calcsize(key_length_format) +
+            len(title) + calcsize(article_length_format) + len(article))
+
+
+def volume_file_names(file_name, total_volumes):
+    """
+    >>> volume_file_names('dict.aar', 1)
+    ['dict.aar']
+    >>> volume_file_names('dict.aar', 2)
+    ['dict.1.aar', 'dict.2.aar']
+
+    """
+    if total_volumes == 1:
+        return [file_name]
+    root, ext = os.path.splitext(file_name)
+    return ['%s.%d%s' % (root, n, ext) for n in range(1, total_volumes + 1)]
+
+
+class Writer(object):
+    """
+    Writes articles to dictionary file_name, split into volumes
+    file_name.1, file_name.2 etc. if they do not fit into
+    max_volume_size bytes. With block_size articles are stored in
+    compressed blocks (format version 2), otherwise each is compressed
+    separately. Names of written files are available as file_names
+    once write() is done.
+
+    """
+
+    def __init__(self, file_name, metadata=None, compression='zlib',
+                 max_volume_size=default_max_volume_size, processes=None,
+                 block_size=None):
+        if compression not in compressors:
+            raise ValueError('Unsupported compression %r' % compression)
+        if max_volume_size > 0xffffffff:
+            raise ValueError('Volume size must fit article offset in 4 bytes')
+        self.file_name = file_name
+        self.metadata = dict(metadata or {})
+        self.compression = compression
+        self.max_volume_size = max_volume_size
+        self.processes = processes or cpu_count()
+        self.block_size = block_size
+        self.file_names = []
+
+    def _new_volume(self, tmp_dir, n, fixed_size):
+        if self.block_size:
+            return _VolumeData(tmp_dir, n, fixed_size,
+                               compressors[self.compression], self.block_size)
+        return _VolumeData(tmp_dir, n, fixed_size)
+
+    def write(self, records):
+        """
+        Write (title, text, meta) records, generating (stage, count)
+        progress tuples, where stage is 'compressing', 'sorting' or
+        'writing'.
+
+        """
+        tmp_dir = tempfile.mkdtemp(prefix='.aarddict-',
+                                   dir=os.path.dirname(
+                                       os.path.abspath(self.file_name)))
+        try:
+            for progress in self._write(records, tmp_dir):
+                yield progress
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _prepared(self, records):
+        #in block mode articles are compressed with their block
+        compression = None if self.block_size else self.compression
+        args = ((title, text, meta or {}, compression)
+                for title, text, meta in records)
+        if self.processes > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                for result in pool.imap(_prepare, args, chunksize=100):
+                    yield result
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for arg in args:
+                yield _prepare(arg)
+
+    def _write(self, records, tmp_dir):
+        articles = open(os.path.join(tmp_dir, 'articles'), 'w+b')
+        keys = open(os.path.join(tmp_dir, 'keys'), 'w+b')
+        try:
+            count = 0
+            pos = 0
+            block = []
+            for key, title, data in self._prepared(records):
+                articles.write(data)
+                block.append((key, title, count, pos, len(data)))
+                pos += len(data)
+                count += 1
+                if len(block) == sort_block_size:
+                    dump_records(block, keys)
+                    block = []
+                    yield 'compressing', count
+            dump_records(block, keys)
+            yield 'compressing', count
+
+            keys.seek(0)
+            self.metadata.setdefault('article_count', count)
+            raw_meta = zlib.compress(simplejson.dumps(self.metadata))
+            fixed_size = spec_len(HEADER_SPEC) + len(raw_meta)
+            volumes = []
+            try:
+                volume = None
+                for n, (_, title, _, pos, length) in enumerate(
+                    external_sort(load_records(keys))):
+                    articles.seek(pos)
+                    article = articles.read(length)
+                    if (volume is None or
+                        (volume.count and volume.size +
+                         entry_size(title, article, volume.item_format) >
+                         self.max_volume_size)):
+                        volume = self._new_volume(tmp_dir, len(volumes),
+                                                  fixed_size)
+                        volumes.append(volume)
+                    volume.add(title, article)
+                    if n % sort_block_size == 0:
+                        yield 'sorting', n
+                yield 'sorting', count
+                if not volumes:
+                    volumes.append(self._new_volume(tmp_dir, 0, fixed_size))
+                file_names = volume_file_names(self.file_name, len(volumes))
+                for progress in _assemble(volumes, file_names, raw_meta,
+                                          uuid4().bytes, tmp_dir):
+                    yield progress
+                self.file_names = file_names
+            finally:
+                for volume in volumes:
+                    volume.close()
+        finally:
+            articles.close()
+            keys.close()
+
+def _assemble(volumes, file_names, raw_meta, uuid, tmp_dir,
+              first_volume=1, total_volumes=None):
+    """
+    Write each of volumes with header, metadata and sections to
+    corresponding file name, generating ('writing', n) progress.
+
+    """
+    tmp_names = []
+    for n, volume in enumerate(volumes):
+        volume.flush()
+        index1_offset = spec_len(HEADER_SPEC) + len(raw_meta)
+        article_offset = (index1_offset + volume.index1.tell() +
+                          volume.index2.tell())
+        header = dict(signature='aard',
+                      sha1sum='0'*40,
+                      version=volume.version,
+                      uuid=uuid,
+                      volume=first_volume + n,
+                      total_volumes=total_volumes or len(volumes),
+                      meta_length=len(raw_meta),
+                      index_count=volume.count,
+                      article_offset=article_offset,
+                      index1_item_format=volume.item_format,
+                      key_length_format=key_length_format,
+                      article_length_format=article_length_format)
+        tmp_name = os.path.join(tmp_dir, '%d.aar' % n)
+        digest = sha1()
+        with open(tmp_name, 'wb') as out:
+            head = ''.join(pack(fmt, header[name])
+                           for name, fmt in HEADER_SPEC)
+            signed = spec_len(HEADER_SPEC[:2])
+            out.write(head)
+            digest.update(head[signed:])
+            out.write(raw_meta)
+            digest.update(raw_meta)
+            for f in volume.files:
+                f.seek(0)
+                while True:
+                    s = f.read(1 << 20)
+                    if not s:
+                        break
+                    out.write(s)
+                    digest.update(s)
+            out.seek(calcsize(HEADER_SPEC[0][1]))
+            out.write(digest.hexdigest())
+        tmp_names.append(tmp_name)
+        yield 'writing', n + 1
+    for tmp_name, file_name in zip(tmp_names, file_names):
+        replace_file(tmp_name, file_name)
+
+
+def convert(file_name, output_file_name, compression='zlib',
+            block_size=default_block_size):
+    """
+    Rewrite volume file_name as format version 2 volume
+    output_file_name, with articles packed into compressed blocks of
+    about block_size bytes, generating ('converting', count) and
+    ('writing', 1) progress. Words keep their order, so sidecar
+    indexes built for the original can be rebuilt the same way.
+
+    """
+    if compression not in compressors:
+        raise ValueError('Unsupported compression %r' % compression)
+    volume = Volume(file_name)
+    tmp_dir = tempfile.mkdtemp(prefix='.aarddict-',
+                               dir=os.path.dirname(
+                                   os.path.abspath(output_file_name)))
+    try:
+        raw_meta = zlib.compress(simplejson.dumps(volume.metadata))
+        data = _VolumeData(tmp_dir, 0, 0, compressors[compression], block_size)
+        try:
+            index1 = volume.index1
+            for start in xrange(0, len(volume), sort_block_size):
+                key_pointers, _ = index1.pointers(start,
+                                                  start + sort_block_size)
+                for i, key_pos in enumerate(key_pointers):
+                    title = volume.words.alist.read_key(int(key_pos))
+                    article = volume.articles[start + i]
+                    data.add(title, article)
+                yield 'converting', min(len(volume), start + sort_block_size)
+            for progress in _assemble([data], [output_file_name], raw_meta,
+                                      volume.uuid.bytes, tmp_dir,
+                                      volume.volume, volume.total_volumes):
+                yield progress
+        finally:
+            data.close()
+    finally:
+        volume.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_jsonl(file_names):
+    """
+    Generate (title, text, meta) records from files with one JSON
+    object with title, text and optional meta keys per line.
+
+    """
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = simplejson.loads(line)
+                yield item['title'], item.get('text', u''), item.get('meta', {})
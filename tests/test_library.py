@@ -0,0 +1,170 @@
+import os
+import shutil
+import tempfile
+
+from aarddict import dictionary
+from aarddict.writer import Writer
+
+titles = [u'ab', u'Ab', u'AB', u'\xe1b', u'abc', u'Abc', u'ab c', u'abd',
+          u'\xe1bd', u'b', u'ba', u'abba', u'Abba', u'a', u'ac', u'bc']
+
+redirects = {'one.aar': [(u'ca', u'ac')],
+             'two.aar': [(u'go abc', u'Abc'), (u'lost', u'nowhere')]}
+
+queries = [u'ab', u'AB', u'\xe1b', u'abd', u'ab#Usage', u'b', u'a', u'zz']
+
+
+def setup():
+    global tmp_dir, volume_cache_file, library
+    tmp_dir = tempfile.mkdtemp()
+    volume_cache_file = dictionary.volume_cache_file
+    dictionary.volume_cache_file = os.path.join(tmp_dir, 'volumes.json')
+    library = dictionary.Library()
+    #two dictionaries, the first split into several volumes
+    for name, part, max_volume_size in (('one.aar', titles[::2], 400),
+                                        ('two.aar', titles[1::2], None)):
+        kwargs = {}
+        if max_volume_size:
+            kwargs['max_volume_size'] = max_volume_size
+        writer = Writer(os.path.join(tmp_dir, name), {'title': name},
+                        processes=1, **kwargs)
+        records = [(title, u'<p>%s</p>' % title, {}) for title in part]
+        records.extend((title, u'', {u'r': target})
+                       for title, target in redirects[name])
+        for progress in writer.write(iter(records)):
+            pass
+        for file_name in writer.file_names:
+            library.add(file_name)
+    assert len(library) > 2
+
+
+def teardown():
+    library.executor = None
+    for volume in library:
+        volume.close()
+    dictionary.volume_cache_file = volume_cache_file
+    shutil.rmtree(tmp_dir)
+
+
+def key(entry):
+    return entry.volume_id, entry.index, entry.title, entry.section
+
+
+def test_executor_matches_serial():
+    serial = {}
+    for word in queries:
+        for max_from_vol in (1, 2, 10**6):
+            serial[word, max_from_vol] = [
+                key(e) for e in library.best_match(word, max_from_vol)]
+    library.executor = dictionary.WorkerPool(2)
+    try:
+        for (word, max_from_vol), expected in serial.iteritems():
+            got = [key(e) for e in library.best_match(word, max_from_vol)]
+            assert got == expected, (word, max_from_vol, got, expected)
+        #abandoned lookup must not affect the next one
+        library.best_match(u'ab').next()
+        got = [key(e) for e in library.best_match(u'ab', 10**6)]
+        assert got == serial[u'ab', 10**6]
+    finally:
+        library.executor.shutdown()
+        library.executor = None
+
+
+def check_catalog():
+    for vol in library:
+        assert library.volume(vol.volume_id) is vol
+    uuids = set(vol.uuid for vol in library)
+    assert library.uuids() == uuids
+    for uuid in uuids:
+        expected = sorted((vol for vol in library if vol.uuid == uuid),
+                          key=lambda vol: vol.volume)
+        assert library.volumes(uuid) == expected
+
+
+def test_catalog_follows_changes():
+    volumes = list(library)
+    check_catalog()
+    try:
+        last = library.pop()
+        check_catalog()
+        assert library.volume(last.volume_id) is None
+        assert last.uuid not in library.uuids()
+        #volume of a split dictionary
+        first = library[0]
+        library.remove(first)
+        check_catalog()
+        assert library.volume(first.volume_id) is None
+        assert first not in library.volumes(first.uuid)
+        library.extend([last, first])
+        check_catalog()
+        library.sort(key=lambda vol: vol.volume_id, reverse=True)
+        check_catalog()
+        assert library.add_volume(first) is first
+        assert len(library) == len(volumes)
+    finally:
+        library[:] = volumes
+    check_catalog()
+
+
+def read(title):
+    entry = library.best_match(title, 1).next()
+    assert entry.title == title
+    return entry
+
+
+def test_redirect_cache():
+    volumes = list(library)
+    cache = library.redirect_cache
+    article = library.read(read(u'go abc'))
+    assert article.entry.title == u'Abc'
+    assert article.entry.redirect_from.title == u'go abc'
+    assert len(cache) == 1
+    assert library.read(read(u'ca')).entry.title == u'ac'
+    lost = read(u'lost')
+    for i in range(2):
+        try:
+            library.read(lost)
+        except dictionary.ArticleNotFound:
+            pass
+        else:
+            assert False, 'redirect to missing article resolved'
+        assert cache.get((lost.volume_id, lost.index, lost.section)) is None
+        assert len(cache) == 3
+        #unresolved target is not looked up again
+        library._find = None
+    del library._find
+    try:
+        for change in (lambda: library.sort(key=lambda vol: vol.volume_id),
+                       library.pop, lambda: library.remove(library[0])):
+            library[:] = volumes
+            library.read(read(u'go abc'))
+            assert len(cache)
+            change()
+            assert len(cache) == 0
+    finally:
+        library[:] = volumes
+
+
+def test_lookup_many_matches_best_match():
+    words = queries + [u'', u'Ab', u'ab', u'ca', u'go', u'\xe1bd#History']
+    for max_from_vol in (1, 2, 10**6):
+        results = list(library.lookup_many(words, max_from_vol))
+        assert sorted(query for query, _ in results) == sorted(words)
+        for query, entries in results:
+            expected = [key(e) for e in library.best_match(query, max_from_vol)]
+            got = [key(e) for e in entries]
+            assert got == expected, (query, max_from_vol, got, expected)
+
+
+def test_volume_lookup_many():
+    words = [word for word in queries if u'#' not in word] + [u'Ab', u'ca']
+    for vol in library:
+        for strength in (dictionary.PRIMARY, dictionary.SECONDARY,
+                         dictionary.TERTIARY):
+            for cmp_func in (dictionary.cmp_word_start,
+                             dictionary.cmp_word_exact):
+                for word, entries in vol.lookup_many(words, strength,
+                                                     cmp_func):
+                    expected = [key(e) for e in
+                                vol.lookup(word, strength, cmp_func)]
+                    assert [key(e) for e in entries] == expected, word
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from aarddict import dictionary
+from aarddict.writer import Writer
+
+titles = [u'ﬁle', u'file', u'File', u'FILE', u'files', u'ﬁles', u'fi',
+          u'strasse', u'Strasse', u'Straßenbahn', u'STRASSE', u'ß', u'ss',
+          u'SS', u'æther', u'aether', u'Aether', u'Æther', u'œuvre',
+          u'oeuvre', u'élan', u'Élan', u'elan', u'Elan', u'ab', u'Ab',
+          u'áb', u'ab#History', u'abc', u'b']
+
+queries = [u'ﬁle', u'file', u'FILE', u'fi', u'ﬁ', u'straße', u'Straß',
+           u'strasse', u'STRASSE', u'ß', u'ss', u'æther', u'ae', u'æ',
+           u'Aether', u'œ', u'oe', u'élan', u'ELAN', u'e', u'ab',
+           u'ab#Usage', u'áb', u'a', u'zz']
+
+
+def setup():
+    global tmp_dir, volume_cache_file, index_dir, library
+    tmp_dir = tempfile.mkdtemp()
+    volume_cache_file = dictionary.volume_cache_file
+    dictionary.volume_cache_file = os.path.join(tmp_dir, 'volumes.json')
+    index_dir = dictionary.index_dir
+    dictionary.index_dir = os.path.join(tmp_dir, 'index')
+    library = dictionary.Library()
+    for name, part in (('one.aar', titles[::2]), ('two.aar', titles[1::2]),
+                       ('all.aar', titles)):
+        writer = Writer(os.path.join(tmp_dir, name), {'title': name},
+                        processes=1)
+        records = [(title, u'<p>%s</p>' % title, {}) for title in part]
+        for progress in writer.write(iter(records)):
+            pass
+        for file_name in writer.file_names:
+            library.add(file_name)
+    #one volume bisects precomputed sort keys, others compute them
+    for progress in library[-1].build_sort_key_index():
+        pass
+    assert library[-1].sort_key_index
+
+
+def teardown():
+    for volume in library:
+        volume.close()
+    dictionary.volume_cache_file = volume_cache_file
+    dictionary.index_dir = index_dir
+    shutil.rmtree(tmp_dir)
+
+
+def key(entry):
+    return entry.volume_id, entry.index, entry.title, entry.section
+
+
+def tier_by_tier(word, comparisons, max_from_vol):
+    """
+    Entries looked up one comparison at a time with Volume.lookup,
+    the way Library did before tiers shared one bisect.
+
+    """
+    word, section = dictionary.split_word(word)
+    counts = {}
+    seen = set()
+    result = []
+    for cmp_func, strength in comparisons:
+        for vol in library:
+            count = counts.get(vol.volume_id, 0)
+            if count >= max_from_vol:
+                continue
+            for entry in vol.lookup(word, strength, cmp_func):
+                if entry not in seen:
+                    if section and not entry.section:
+                        entry.section = section
+                    result.append(key(entry))
+                    seen.add(entry)
+                    count += 1
+                    if count >= max_from_vol:
+                        break
+            counts[vol.volume_id] = count
+    return result
+
+
+def test_best_match_tiers():
+    comparisons = library.best_match_comparisons
+    for word in queries:
+        for max_from_vol in (1, 3, 10**6):
+            expected = tier_by_tier(word, comparisons, max_from_vol)
+            got = [key(e) for e in library.best_match(word, max_from_vol)]
+            assert got == expected, (word, max_from_vol, got, expected)
+
+
+def test_expansions_and_ligatures():
+    titles = [e.title for e in library.best_match(u'ﬁle', 10**6)]
+    assert u'ﬁle' in titles and u'file' in titles, titles
+    titles = [e.title for e in library.best_match(u'straße', 10**6)]
+    assert u'strasse' in titles and u'Straßenbahn' in titles, titles
+
+
+def test_count():
+    strengths = (dictionary.PRIMARY, dictionary.SECONDARY,
+                 dictionary.TERTIARY)
+    modes = (dictionary.cmp_word_start, dictionary.cmp_word_exact)
+    for word in queries + [u'Straß', u'STRAß', u'strasse', u'Æ']:
+        lookup_word, _ = dictionary.split_word(word)
+        for strength in strengths:
+            for cmp_func in modes:
+                total = 0
+                for vol in library:
+                    expected = len(list(vol.lookup(lookup_word, strength,
+                                                   cmp_func)))
+                    count = vol.count(lookup_word, strength, cmp_func)
+                    assert count == expected, (word, strength, cmp_func,
+                                               count, expected)
+                    total += expected
+                assert library.count(word, strength, cmp_func) == total
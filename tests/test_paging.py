@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+
+from aarddict import dictionary
+from aarddict.writer import Writer
+
+titles = [u'ab', u'Ab', u'AB', u'\xe1b', u'\xc1b', u'abc', u'Abc', u'ab c',
+          u'ab#History', u'abd', u'\xe1bd', u'ABD', u'abe', u'b', u'ba',
+          u'Ab#Usage', u'abba', u'Abba', u'a', u'ac']
+
+
+def setup():
+    global tmp_dir, volume_cache_file, library
+    tmp_dir = tempfile.mkdtemp()
+    volume_cache_file = dictionary.volume_cache_file
+    dictionary.volume_cache_file = os.path.join(tmp_dir, 'volumes.json')
+    library = dictionary.Library()
+    #two dictionaries, the second split into several volumes
+    for name, part, max_volume_size in (('one.aar', titles[::2], None),
+                                        ('two.aar', titles[1::2], 400)):
+        kwargs = {}
+        if max_volume_size:
+            kwargs['max_volume_size'] = max_volume_size
+        writer = Writer(os.path.join(tmp_dir, name), {'title': name},
+                        processes=1, **kwargs)
+        records = [(title, u'<p>%s</p>' % title, {}) for title in part]
+        for progress in writer.write(iter(records)):
+            pass
+        for file_name in writer.file_names:
+            library.add(file_name)
+    assert len(library) > 2
+
+
+def teardown():
+    for volume in library:
+        volume.close()
+    dictionary.volume_cache_file = volume_cache_file
+    shutil.rmtree(tmp_dir)
+
+
+def key(entry):
+    return entry.volume_id, entry.index, entry.title, entry.section
+
+
+def check_pages(word, page_size):
+    expected = [key(e) for e in library.best_match(word, max_from_vol=10**6)]
+    paged = []
+    cursor = None
+    pages = 0
+    while True:
+        entries, cursor = library.best_match_page(word, page_size, cursor)
+        assert len(entries) <= page_size
+        paged.extend(key(e) for e in entries)
+        pages += 1
+        if cursor is None:
+            break
+        assert pages <= len(expected) + 1, word
+    assert paged == expected, (word, page_size, paged, expected)
+    return expected
+
+
+def test_pages_match_best_match():
+    for word in (u'ab', u'AB', u'\xe1b', u'abd', u'b', u'a', u'zz'):
+        for page_size in (1, 2, 3, 50):
+            check_pages(word, page_size)
+    assert len(check_pages(u'ab', 2)) > 4
+
+
+def test_pages_with_section():
+    for page_size in (1, 2, 5):
+        expected = check_pages(u'ab#Usage', page_size)
+        #titles without a section of their own get the one looked up
+        assert [section for _, _, title, section in expected
+                if u'#' not in title and section != u'Usage'] == []
+
+
+def test_cursor_for_other_word():
+    entries, cursor = library.best_match_page(u'ab', 1)
+    assert cursor
+    try:
+        library.best_match_page(u'abc', 1, cursor)
+    except ValueError:
+        pass
+    else:
+        assert False, 'cursor accepted for a different word'
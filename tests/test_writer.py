@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+
+from aarddict import dictionary
+from aarddict.writer import Writer, convert
+
+articles = [(u'hydrogen', u'<p>Hydrogen</p>', {}),
+            (u'Helium', u'<p>Helium</p>', {}),
+            (u'\xe9lan', u'<p>Elan</p>', {}),
+            (u'H', u'', {u'r': u'hydrogen'}),
+            (u'abc', u'<p>abc</p>', {})]
+
+
+def setup():
+    global tmp_dir, volume_cache_file, index_dir
+    tmp_dir = tempfile.mkdtemp()
+    volume_cache_file = dictionary.volume_cache_file
+    dictionary.volume_cache_file = os.path.join(tmp_dir, 'volumes.json')
+    index_dir = dictionary.index_dir
+    dictionary.index_dir = os.path.join(tmp_dir, 'index')
+
+
+def teardown():
+    dictionary.volume_cache_file = volume_cache_file
+    dictionary.index_dir = index_dir
+    shutil.rmtree(tmp_dir)
+
+
+def write(name, **kwargs):
+    writer = Writer(os.path.join(tmp_dir, name), {'title': u'Test'},
+                    processes=1, **kwargs)
+    for progress in writer.write(iter(articles)):
+        pass
+    return writer.file_names
+
+
+def check_volume(file_name, version=1):
+    volume = dictionary.Volume(file_name)
+    try:
+        assert len(volume) == len(articles)
+        assert volume.title == u'Test'
+        assert volume.article_count == len(articles)
+        assert volume.format_version == version
+        words = list(volume.words.alist)
+        keys = [dictionary.collation_key(w, dictionary.TERTIARY).getByteArray()
+                for w in words]
+        assert keys == sorted(keys), words
+        for title, text, meta in articles:
+            entries = list(volume[title])
+            assert len(entries) == 1, title
+            article = volume.read(entries[0])
+            if meta:
+                assert article.target == meta[u'r']
+            else:
+                assert article.text == text
+        offset = dictionary.spec_len(dictionary.HEADER_SPEC[:2])
+        for pos, result in dictionary.calcsha1(file_name, offset):
+            pass
+        assert result.hexdigest() == volume.sha1sum
+    finally:
+        volume.close()
+
+
+def test_round_trip():
+    file_names = write('test.aar')
+    assert len(file_names) == 1
+    check_volume(file_names[0])
+
+
+def test_block_round_trip():
+    file_names = write('blocks.aar', block_size=32)
+    assert len(file_names) == 1
+    check_volume(file_names[0], version=2)
+
+
+def test_convert():
+    file_names = write('v1.aar')
+    v2_file_name = os.path.join(tmp_dir, 'v2.aar')
+    for progress in convert(file_names[0], v2_file_name, block_size=32):
+        pass
+    check_volume(v2_file_name, version=2)
+    v1 = dictionary.Volume(file_names[0])
+    v2 = dictionary.Volume(v2_file_name)
+    try:
+        assert v1.uuid == v2.uuid
+        assert v1.metadata == v2.metadata
+        assert list(v1.words.alist) == list(v2.words.alist)
+    finally:
+        v1.close()
+        v2.close()
+
+
+def test_volume_split():
+    file_names = write('split.aar', max_volume_size=300)
+    assert len(file_names) > 1, file_names
+    library = dictionary.Library()
+    try:
+        for file_name in file_names:
+            library.add(file_name)
+        assert len(set(volume.uuid for volume in library)) == 1
+        assert sum(len(volume) for volume in library) == len(articles)
+        for volume in library:
+            assert volume.total_volumes == len(file_names)
+        for title, text, meta in articles:
+            entry = list(library.best_match(title))[0]
+            assert library.read(entry).text == (text or u'<p>Hydrogen</p>')
+    finally:
+        for volume in library:
+            volume.close()
+
+
+def test_sidecars():
+    file_names = write('sidecars.aar')
+    volume = dictionary.Volume(file_names[0])
+    try:
+        for progress in volume.build_substring_index():
+            pass
+        assert [e.title for e in volume.search_substring(u'eli')] == [u'Helium']
+        for progress in volume.build_fulltext_index(processes=1):
+            pass
+        assert [e.title for e in volume.search_text(u'helium')] == [u'Helium']
+        for query in (u'', u'!!', u'""'):
+            assert volume.search_text(query) == []
+        #building one index leaves others open and usable
+        for progress in volume.build_fuzzy_index():
+            pass
+        assert [e.title for e in volume.search_text(u'helium')] == [u'Helium']
+        assert [e.title for e in volume.search_substring(u'eli')] == [u'Helium']
+        assert volume.substring_index
+        assert [e.title for e in volume.fuzzy_lookup(u'hydrogem')] == [
+            u'hydrogen']
+    finally:
+        volume.close()
+
+
+def test_cached_open_skips_metadata():
+    siteinfo = {u'general': {u'server': u'http://en.wikipedia.org',
+                             u'articlepath': u'/wiki/$1'}}
+    writer = Writer(os.path.join(tmp_dir, 'site.aar'),
+                    {'title': u'Site', 'siteinfo': siteinfo}, processes=1)
+    for progress in writer.write(iter(articles)):
+        pass
+    file_name = writer.file_names[0]
+    other_file_name = write('other.aar')[0]
+    #volumes are now in volume cache
+    for name in (file_name, other_file_name):
+        dictionary.Volume(name).close()
+    library = dictionary.Library()
+    try:
+        first = library.add(file_name)
+        library.add(other_file_name)
+        url = u'http://en.wikipedia.org/wiki/$1'
+        assert library.dict_by_article_url(url) == first.uuid
+        assert first.article_url == url
+        assert first._metadata is None
+        assert first.metadata['siteinfo'] == siteinfo
+    finally:
+        for volume in library:
+            volume.close()